@@ -0,0 +1,250 @@
+import struct
+import numpy as np
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+from paintengine import Layer, PixelCanvas, imageArray, paletteIndices
+from paintio import ImageJob, writeImage
+
+"""Animation timeline: every frame is a layer stack, stored as the tiles that differ from its keyframe."""
+
+class Frame: # a stored frame, tiles are pixel copies keyed (layer index, tx, ty)
+    def __init__(self, layers, active=0, key=None):
+        self.width = layers[0].width
+        self.height = layers[0].height
+        self.palette = None if layers[0].palette is None else list(layers[0].palette)
+        self.props = [(layer.name, layer.visible, layer.opacity, layer.blend_mode) for layer in layers]
+        self.active = active
+        tiles = {(index, tx, ty): imageArray(image).copy()
+                 for index, layer in enumerate(layers) for (tx, ty), image in layer.tiles.items()}
+        if key is not None and not key.compatible(self):
+            key = None
+        self.key = key # keyframe this frame is a delta against, None for a keyframe
+        if key is None:
+            self.tiles = tiles
+            self.removed = set()
+        else: # only what differs from the keyframe
+            self.tiles = {k: pixels for k, pixels in tiles.items() if k not in key.tiles or not np.array_equal(pixels, key.tiles[k])}
+            self.removed = set(key.tiles) - set(tiles) # tiles the keyframe has and this frame does not
+
+    def compatible(self, other): # same pixel layout, so tiles can be compared one to one
+        return (self.width, self.height, self.palette, len(self.props)) == (other.width, other.height, other.palette, len(other.props))
+
+    def sameAs(self, other):
+        if not self.compatible(other) or self.props != other.props or self.tiles.keys() != other.tiles.keys():
+            return False
+        return all(np.array_equal(pixels, other.tiles[k]) for k, pixels in self.tiles.items())
+
+    def nbytes(self):
+        return sum(pixels.nbytes for pixels in self.tiles.values())
+
+    def layers(self): # new Layer objects holding this frame's pixels
+        tiles = dict(self.key.tiles) if self.key else {}
+        for k in self.removed:
+            del tiles[k]
+        tiles.update(self.tiles)
+        palette = None if self.palette is None else list(self.palette) # one table shared by the frame's layers
+        layers = []
+        for name, visible, opacity, blend_mode in self.props:
+            layer = Layer(self.width, self.height, name, palette)
+            layer.visible = visible
+            layer.opacity = opacity
+            layer.blend_mode = blend_mode
+            layers.append(layer)
+        for (index, tx, ty), pixels in tiles.items():
+            imageArray(layers[index].tile(tx, ty, create=True))[:] = pixels
+        return layers
+
+class Timeline: # the current frame lives in the engine, it is stored only when another frame needs it
+    KEYFRAME_INTERVAL = 8 # frames per keyframe, its deltas grow as the animation drifts away from it
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.reset()
+
+    def reset(self): # a single frame, the engine's
+        self.frames = [None] # None for the current frame while only the engine holds it
+        self.current = 0
+        self.key = None # keyframe the current frame was stored against
+        self.images = {} # Frame -> flattened QImage, the playback and onion skin cache
+
+    def __len__(self):
+        return len(self.frames)
+
+    def dependents(self, key):
+        return [index for index, frame in enumerate(self.frames) if frame is not None and frame.key is key]
+
+    def keyBefore(self, index): # keyframe a frame at index would be stored against, None to start a new one
+        if index == 0:
+            return None
+        previous = self.frames[index - 1]
+        key = previous if previous.key is None else previous.key
+        return key if len(self.dependents(key)) < self.KEYFRAME_INTERVAL - 1 else None
+
+    def store(self): # encode the engine's layers into the current frame
+        old = self.frames[self.current]
+        if old is None:
+            key = self.key if any(frame is self.key for frame in self.frames) else None
+            self.frames[self.current] = Frame(self.engine.layers, self.engine.active, key)
+            return
+        # a keyframe other frames depend on stays stored while it is edited, its deltas are rebased if the pixels changed
+        frame = Frame(self.engine.layers, self.engine.active)
+        if frame.sameAs(old):
+            old.active = frame.active
+            return
+        dependents = [(index, self.frames[index].layers(), self.frames[index].active) for index in self.dependents(old)]
+        self.replace(self.current, frame)
+        for index, layers, active in dependents:
+            self.replace(index, Frame(layers, active, frame))
+
+    def replace(self, index, frame):
+        self.images.pop(self.frames[index], None)
+        self.frames[index] = frame
+
+    def select(self, index): # store the current frame and load another one into the engine
+        self.store()
+        self.load(index)
+
+    def load(self, index):
+        self.current = index
+        frame = self.frames[index]
+        self.engine.loadLayers(frame.layers(), frame.active)
+        self.key = frame.key
+        if not self.dependents(frame): # nothing is stored against it, the engine's copy is enough
+            self.replace(index, None)
+
+    def addFrame(self, copy=False): # after the current one, a copy of it or blank layers with the same properties
+        self.store()
+        layers = self.engine.layers
+        if not copy:
+            blank = []
+            for layer in layers:
+                blank.append(Layer(layer.width, layer.height, layer.name, layer.palette))
+                blank[-1].copyProps(layer)
+            layers = blank
+        index = self.current + 1
+        self.frames.insert(index, Frame(layers, self.engine.active, self.keyBefore(index)))
+        self.load(index)
+
+    def removeFrame(self):
+        if len(self.frames) == 1:
+            return
+        removed = self.frames.pop(self.current)
+        self.images.pop(removed, None)
+        dependents = self.dependents(removed) if removed is not None else []
+        if dependents: # the first delta becomes the keyframe of the others
+            decoded = [(index, self.frames[index].layers(), self.frames[index].active) for index in dependents]
+            key = None
+            for index, layers, active in decoded:
+                self.replace(index, Frame(layers, active, key))
+                key = key or self.frames[index]
+        self.load(min(self.current, len(self.frames) - 1))
+
+    def image(self, index): # flattened frame, cached unless it is the one being edited
+        if index == self.current:
+            return self.engine.flatten()
+        frame = self.frames[index]
+        if frame not in self.images:
+            canvas = PixelCanvas()
+            canvas.loadLayers(frame.layers())
+            self.images[frame] = canvas.flatten()
+        return self.images[frame]
+
+    def renderAll(self): # every frame flattened, in order
+        return [self.image(index) for index in range(len(self.frames))]
+
+    def storedBytes(self):
+        return sum(frame.nbytes() for frame in self.frames if frame is not None)
+
+def writeStrip(images, path): # frames side by side, left to right
+    width, height = images[0].width(), images[0].height()
+    strip = QImage(width * len(images), height, QImage.Format_ARGB32)
+    strip.fill(Qt.transparent)
+    painter = QPainter(strip)
+    painter.setCompositionMode(QPainter.CompositionMode_Source)
+    for index, image in enumerate(images):
+        painter.drawImage(index * width, 0, image)
+    painter.end()
+    return writeImage(strip, path)
+
+def gifIndices(image): # palette and indices of one frame, entry 0 transparent, more than 255 colours map to the most common
+    image = image.convertToFormat(QImage.Format_ARGB32)
+    pixels = imageArray(image)
+    pixels = np.where(pixels >> 24 < 128, np.uint32(0), pixels | np.uint32(0xFF000000)) # GIF has no partial alpha
+    colors, counts = np.unique(pixels[pixels != 0], return_counts=True)
+    palette = [0] + colors[np.argsort(-counts, kind="stable")][:255].tolist()
+    return palette, paletteIndices(pixels, palette)
+
+def lzwCompress(indices, code_size): # GIF flavour of LZW, variable width codes, table cleared when it fills up
+    clear, end = 1 << code_size, (1 << code_size) + 1
+    out = bytearray()
+    buffer = bits = 0
+    width = code_size + 1
+    table = {}
+    next_code = end + 1
+
+    def emit(code, width):
+        nonlocal buffer, bits
+        buffer |= code << bits
+        bits += width
+        while bits >= 8:
+            out.append(buffer & 0xFF)
+            buffer >>= 8
+            bits -= 8
+
+    emit(clear, width)
+    data = indices.ravel().tolist()
+    prefix = data[0]
+    for value in data[1:]:
+        code = table.get((prefix, value))
+        if code is not None:
+            prefix = code
+            continue
+        emit(prefix, width)
+        if next_code < 4096:
+            table[(prefix, value)] = next_code
+            if next_code == 1 << width and width < 12:
+                width += 1
+            next_code += 1
+        else:
+            emit(clear, width)
+            table = {}
+            next_code = end + 1
+            width = code_size + 1
+        prefix = value
+    emit(prefix, width)
+    emit(end, width)
+    if bits:
+        out.append(buffer & 0xFF)
+    return bytes(out)
+
+def gifFrame(image, delay): # graphic control, image descriptor, local colour table and LZW data of one frame
+    palette, indices = gifIndices(image)
+    depth = max(1, (len(palette) - 1).bit_length())
+    table = bytearray()
+    for color in palette + [0] * ((1 << depth) - len(palette)):
+        table += bytes(((color >> 16) & 0xFF, (color >> 8) & 0xFF, color & 0xFF))
+    code_size = max(2, depth)
+    data = lzwCompress(indices, code_size)
+    blocks = b"".join(bytes([len(data[i:i + 255])]) + data[i:i + 255] for i in range(0, len(data), 255))
+    control = b"\x21\xf9\x04" + struct.pack("<BHB", 0x09, delay, 0) + b"\x00" # restore to background, index 0 transparent
+    descriptor = b"\x2c" + struct.pack("<HHHHB", 0, 0, image.width(), image.height(), 0x80 | (depth - 1))
+    return control + descriptor + bytes(table) + bytes([code_size]) + blocks + b"\x00"
+
+def writeGif(path, width, height, frames): # frames are gifFrame blocks, looping forever
+    header = b"GIF89a" + struct.pack("<HHBBB", width, height, 0, 0, 0)
+    loop = b"\x21\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", 0) + b"\x00"
+    with open(path, "wb") as f:
+        f.write(header + loop + b"".join(frames) + b"\x3b")
+    return path
+
+def stripJob(images, path):
+    job = ImageJob()
+    job.submit(writeStrip, images, path)
+    return job
+
+def gifJob(images, fps): # one task per frame, results are gifFrame blocks for writeGif
+    job = ImageJob()
+    delay = max(2, round(100 / fps)) # hundredths of a second, browsers slow down anything shorter
+    for image in images:
+        job.submit(gifFrame, image, delay)
+    return job
@@ -0,0 +1,116 @@
+import sys
+import os
+import glob
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+from paintengine import PixelCanvas
+
+"""Batch open/edit/save of pixel-art files on a process pool: python paintbatch.py sprites/ -o out --scale 4"""
+
+image_extensions = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".webp", ".tif", ".tiff")
+
+def parseColor(text):
+    color = QColor(text.strip())
+    if not color.isValid():
+        raise argparse.ArgumentTypeError(f"invalid colour: {text}")
+    return color.rgba()
+
+def parseRemap(text): # "#ff0000=#00ff00"
+    source, _, target = text.partition("=")
+    if not target:
+        raise argparse.ArgumentTypeError(f"expected SOURCE=TARGET, got: {text}")
+    return parseColor(source), parseColor(target)
+
+def parseFill(text): # "x,y,#color"
+    parts = text.split(",")
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError(f"expected X,Y,COLOR, got: {text}")
+    try:
+        return int(parts[0]), int(parts[1]), parseColor(parts[2])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected integer coordinates, got: {text}")
+
+def collectInputs(patterns): # directories, globs and plain files -> sorted unique image paths
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            matches = [os.path.join(pattern, name) for name in os.listdir(pattern)]
+        else:
+            matches = glob.glob(pattern, recursive=True) or [pattern]
+        paths.extend(path for path in matches if os.path.isfile(path) and path.lower().endswith(image_extensions))
+    return sorted(set(paths))
+
+def outputPath(path, output_dir, image_format):
+    name, extension = os.path.splitext(os.path.basename(path))
+    return os.path.join(output_dir, f"{name}.{image_format or extension.lstrip('.')}")
+
+def processFile(path, out_path, remap, fills, tolerance, scale): # runs in a worker process
+    start = time.perf_counter()
+    try:
+        reader = QImageReader(path)
+        image = reader.read()
+        if image.isNull():
+            raise ValueError(reader.errorString())
+
+        canvas = PixelCanvas()
+        canvas.load(image)
+        canvas.remap(dict(remap))
+        for x, y, color in fills:
+            canvas.fill(x, y, color, tolerance)
+
+        result = canvas.flatten()
+        if scale > 1: # nearest-neighbour
+            result = result.scaled(result.width() * scale, result.height() * scale, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+        if not result.save(out_path):
+            raise IOError(f"could not write {out_path}")
+        return path, out_path, time.perf_counter() - start, image.width() * image.height(), None
+    except Exception as e:
+        return path, out_path, time.perf_counter() - start, 0, str(e)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply the same edits to many pixel-art files in parallel.")
+    parser.add_argument("inputs", nargs="+", help="image files, directories or glob patterns")
+    parser.add_argument("-o", "--output", required=True, help="directory for the processed files")
+    parser.add_argument("--remap", type=parseRemap, action="append", default=[], metavar="SRC=DST",
+                        help="replace every pixel of colour SRC with DST (repeatable)")
+    parser.add_argument("--fill", type=parseFill, action="append", default=[], metavar="X,Y,COLOR",
+                        help="flood fill from cell X,Y with COLOR (repeatable, applied after remaps)")
+    parser.add_argument("--tolerance", type=int, default=0, help="per-channel tolerance for --fill")
+    parser.add_argument("--scale", type=int, default=1, help="nearest-neighbour upscale factor for export")
+    parser.add_argument("--format", default=None, help="output format/extension, e.g. png, bmp, jpg (default: keep)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    args = parser.parse_args(argv)
+
+    paths = collectInputs(args.inputs)
+    if not paths:
+        print("No input images found.", file=sys.stderr)
+        return 1
+    if args.scale < 1:
+        parser.error("--scale must be at least 1")
+    os.makedirs(args.output, exist_ok=True)
+
+    failures = 0
+    total_pixels = 0
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(processFile, path, outputPath(path, args.output, args.format),
+                               args.remap, args.fill, args.tolerance, args.scale) for path in paths]
+        for future in as_completed(futures): # results are already on disk, report as they finish
+            path, out_path, seconds, pixels, error = future.result()
+            if error:
+                failures += 1
+                print(f"FAIL {path}: {error}", file=sys.stderr)
+            else:
+                total_pixels += pixels
+                print(f"{seconds * 1000:8.1f} ms  {path} -> {out_path}")
+    elapsed = time.perf_counter() - start
+
+    done = len(paths) - failures
+    print(f"{done} files in {elapsed:.2f} s ({done / elapsed:.1f} files/s, {total_pixels / elapsed / 1e6:.2f} Mpx/s), {failures} failed")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,209 @@
+import os
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen") # must be set before Qt is imported
+
+import sys
+import json
+import time
+import random
+import argparse
+import tracemalloc
+from PyQt5.QtCore import *
+from PyQt5.QtWidgets import *
+from PyQt5.QtGui import *
+from paintpmain import Canvas
+
+try:
+    import resource
+except ImportError: # not available on Windows
+    resource = None
+
+"""Benchmarks for the canvas hot paths: python paintbench.py --save baseline.json, later --compare baseline.json"""
+
+grid_sizes = [8, 64, 256, 2048]
+pen_sizes = list(range(1, 11))
+zoom_levels = [0.5, 1, 4, 8, 32, 64]
+moves_per_frame = 8 # mouse moves between two frame timer ticks, a 1000 Hz mouse at 120 Hz
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def mouseEvent(kind, x, y):
+    buttons = Qt.NoButton if kind == QEvent.MouseButtonRelease else Qt.LeftButton
+    return QMouseEvent(kind, QPointF(x, y), Qt.LeftButton, buttons, Qt.NoModifier)
+
+def makeCanvas(grid_size, zoom=1, pen_size=1):
+    canvas = Canvas(grid_size)
+    canvas.pen_size = pen_size
+    canvas.zoom_level = zoom
+    canvas.updateTransform()
+    return canvas
+
+def cellCenter(canvas, x, y): # widget position of a cell's centre
+    scale = canvas.cell_size * canvas.zoom_level
+    return (x + 0.5) * scale, (y + 0.5) * scale
+
+def strokePath(grid_size, points, seed): # random walk of cell positions, like a hand-drawn stroke
+    rng = random.Random(seed)
+    x, y = grid_size // 2, grid_size // 2
+    path = []
+    for _ in range(points):
+        x = min(grid_size - 1, max(0, x + rng.randint(-3, 3)))
+        y = min(grid_size - 1, max(0, y + rng.randint(-3, 3)))
+        path.append((x, y))
+    return path
+
+def timed(samples, action, *args):
+    start = time.perf_counter()
+    action(*args)
+    samples.append(time.perf_counter() - start)
+
+def benchStroke(grid_size, pen_size, zoom, erase=False):
+    canvas = makeCanvas(grid_size, zoom, pen_size)
+    if erase:
+        canvas.changeToErase()
+    samples = []
+    for stroke in range(5):
+        path = strokePath(grid_size, 100, stroke)
+        timed(samples, canvas.mousePressEvent, mouseEvent(QEvent.MouseButtonPress, *cellCenter(canvas, *path[0])))
+        for move, (x, y) in enumerate(path[1:], 1):
+            timed(samples, canvas.mouseMoveEvent, mouseEvent(QEvent.MouseMove, *cellCenter(canvas, x, y)))
+            if move % moves_per_frame == 0: # the frame timer never fires without an event loop
+                timed(samples, canvas.flushInput)
+        timed(samples, canvas.mouseReleaseEvent, mouseEvent(QEvent.MouseButtonRelease, *cellCenter(canvas, *path[-1])))
+    return samples
+
+def benchFill(grid_size, zoom):
+    canvas = makeCanvas(grid_size, zoom)
+    samples = []
+    for color in ["#ff0000", "#00ff00", "#0000ff", "#ffff00"] * 3: # alternate colours so every fill changes the canvas
+        canvas.setPenColor(color)
+        timed(samples, canvas.fillEvent, 0, 0)
+    return samples
+
+def benchHistory(grid_size, zoom):
+    canvas = makeCanvas(grid_size, zoom, pen_size=4)
+    samples = []
+    for x, y in strokePath(grid_size, 50, 7): # press opens a history entry, release commits it
+        position = cellCenter(canvas, x, y)
+        timed(samples, canvas.mousePressEvent, mouseEvent(QEvent.MouseButtonPress, *position))
+        timed(samples, canvas.mouseReleaseEvent, mouseEvent(QEvent.MouseButtonRelease, *position))
+    for _ in range(len(canvas.engine.undo_stack)):
+        timed(samples, canvas.undo)
+    return samples
+
+def benchPaint(grid_size, zoom):
+    canvas = makeCanvas(grid_size, zoom)
+    canvas.changeToFill()
+    canvas.setPenColor("#336699")
+    canvas.fillEvent(0, 0)
+    viewport = QRect(0, 0, 1600, 1000) # what a maximised scroll area would show, scrolled to the middle
+    viewport.moveCenter(canvas.rect().center())
+    viewport = viewport.intersected(canvas.rect())
+    target = QImage(viewport.size(), QImage.Format_ARGB32_Premultiplied)
+    samples = []
+    for _ in range(20): # full viewport repaint
+        timed(samples, canvas.render, target, QPoint(), QRegion(viewport))
+    for x, y in strokePath(grid_size, 100, 3): # hover moves, repainting only what they invalidate
+        region = canvas.cellsToWidget(QRect(x, y, 1, 1)).intersected(viewport)
+        if not region.isEmpty(): # an empty region would render the whole widget
+            timed(samples, canvas.render, target, QPoint(), QRegion(region))
+    return samples
+
+def benchEllipse(grid_size, zoom):
+    canvas = makeCanvas(grid_size, zoom)
+    canvas.changeToEllipse()
+    samples = []
+    rng = random.Random(11)
+    for _ in range(5):
+        timed(samples, canvas.mousePressEvent, mouseEvent(QEvent.MouseButtonPress, *cellCenter(canvas, 0, 0)))
+        for move in range(1, 51):
+            x, y = rng.randrange(grid_size), rng.randrange(grid_size)
+            timed(samples, canvas.mouseMoveEvent, mouseEvent(QEvent.MouseMove, *cellCenter(canvas, x, y)))
+            if move % moves_per_frame == 0:
+                timed(samples, canvas.flushInput)
+        timed(samples, canvas.mouseReleaseEvent, mouseEvent(QEvent.MouseButtonRelease, *cellCenter(canvas, x, y)))
+    return samples
+
+def scenarios(quick=False):
+    grids = grid_sizes[:2] if quick else grid_sizes
+    pens = [1, 5, 10] if quick else pen_sizes
+    zooms = [1, 8] if quick else zoom_levels
+    for grid_size in grids:
+        for zoom in zooms:
+            for pen_size in pens:
+                yield "stroke", dict(grid=grid_size, pen=pen_size, zoom=zoom), benchStroke, (grid_size, pen_size, zoom)
+            yield "erase", dict(grid=grid_size, pen=4, zoom=zoom), benchStroke, (grid_size, 4, zoom, True)
+            yield "fill", dict(grid=grid_size, zoom=zoom), benchFill, (grid_size, zoom)
+            yield "history", dict(grid=grid_size, zoom=zoom), benchHistory, (grid_size, zoom)
+            yield "paint", dict(grid=grid_size, zoom=zoom), benchPaint, (grid_size, zoom)
+            yield "ellipse", dict(grid=grid_size, zoom=zoom), benchEllipse, (grid_size, zoom)
+
+def scenarioKey(name, params):
+    return name + "[" + ",".join(f"{k}={v}" for k, v in params.items()) + "]"
+
+def runScenario(name, params, bench, args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    samples = bench(*args)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "ops_per_sec": len(samples) / elapsed,
+        "p50_ms": percentile(samples, 0.50) * 1000,
+        "p90_ms": percentile(samples, 0.90) * 1000,
+        "p99_ms": percentile(samples, 0.99) * 1000,
+        "max_ms": max(samples) * 1000,
+        "peak_kb": peak / 1024,
+        "events": len(samples),
+    }
+
+def compare(results, baseline, threshold):
+    regressions = 0
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        before, after = baseline[key]["p90_ms"], result["p90_ms"]
+        ratio = after / before if before else 1.0
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        elif ratio < 1 - threshold:
+            flag = "  faster"
+        print(f"{key:45s} p90 {before:8.3f} -> {after:8.3f} ms ({ratio:5.2f}x){flag}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the canvas under the offscreen Qt platform.")
+    parser.add_argument("--quick", action="store_true", help="smaller matrix for a fast check")
+    parser.add_argument("--filter", default="", help="only run scenarios whose key contains this text")
+    parser.add_argument("--save", metavar="JSON", help="write the results as a baseline")
+    parser.add_argument("--compare", metavar="JSON", help="compare p90 latency against a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="relative p90 change reported as a regression")
+    args = parser.parse_args(argv)
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    results = {}
+    for name, params, bench, bench_args in scenarios(args.quick):
+        key = scenarioKey(name, params)
+        if args.filter not in key:
+            continue
+        result = runScenario(name, params, bench, bench_args)
+        results[key] = result
+        print(f"{key:45s} {result['ops_per_sec']:9.0f} ops/s  p50 {result['p50_ms']:7.3f}  p90 {result['p90_ms']:7.3f}"
+              f"  p99 {result['p99_ms']:7.3f} ms  peak {result['peak_kb']:8.0f} KB")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+            json.dump({"platform": QGuiApplication.platformName(), "max_rss_kb": max_rss, "results": results}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        return 1 if compare(results, baseline, args.threshold) else 0
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,880 @@
+import numpy as np
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+"""Headless pixel canvas: tiled layers, strokes, fill, shape rasterizers and history. Needs no QApplication."""
+
+default_grid_size = int(64)
+palette_chunk = 1 << 20 # colour x palette entry distances paletteIndices holds at once, 4 MB per channel
+
+blend_modes = {
+    "Normal": QPainter.CompositionMode_SourceOver,
+    "Multiply": QPainter.CompositionMode_Multiply,
+    "Screen": QPainter.CompositionMode_Screen,
+    "Overlay": QPainter.CompositionMode_Overlay,
+    "Darken": QPainter.CompositionMode_Darken,
+    "Lighten": QPainter.CompositionMode_Lighten,
+    "Add": QPainter.CompositionMode_Plus,
+    "Difference": QPainter.CompositionMode_Difference,
+}
+
+def imageArray(image, writable=True): # (height, width) view of an ARGB32 (uint32) or Indexed8 (uint8) QImage, no copy
+    dtype = np.uint8 if image.format() == QImage.Format_Indexed8 else np.uint32
+    ptr = image.bits() if writable else image.constBits() # bits() detaches an image shared with a Region
+    ptr.setsize(image.sizeInBytes())
+    return np.frombuffer(ptr, dtype).reshape(image.height(), image.bytesPerLine() // np.dtype(dtype).itemsize)[:, :image.width()]
+
+def paletteIndices(pixels, palette): # nearest palette entry for every ARGB pixel, fully transparent ones to entry 0
+    colors, inverse = np.unique(pixels, return_inverse=True) # compare each distinct colour once
+    channels = lambda argb: argb.view(np.uint8).reshape(argb.shape + (4,)).astype(np.int32)
+    table = channels(np.array(palette[1:], np.uint32)) # entry 0 is only for transparency
+    nearest = np.zeros(len(colors), np.uint8)
+    step = max(1, palette_chunk // max(1, len(table)))
+    for start in range(0, len(colors) if len(table) else 0, step): # distances of a bounded block of colours at a time
+        chunk = channels(colors[start:start + step])
+        distance = sum((chunk[:, None, channel] - table[None, :, channel]) ** 2 for channel in range(4))
+        nearest[start:start + step] = distance.argmin(axis=1) + 1
+    nearest[(colors >> 24) == 0] = 0
+    return nearest[inverse].reshape(pixels.shape)
+
+def blendOver(pixels, argb): # source-over of one straight-alpha ARGB colour onto an array of pixels
+    src_a = (argb >> 24) & 0xFF
+    if src_a == 255 or not pixels.size:
+        return np.full(pixels.shape, argb, np.uint32)
+    if src_a == 0:
+        return pixels.copy()
+    dst = pixels.view(np.uint8).reshape(pixels.shape + (4,)).astype(np.float32) # B, G, R, A on little endian
+    src = np.array([argb & 0xFF, (argb >> 8) & 0xFF, (argb >> 16) & 0xFF], np.float32)
+    sa = src_a / 255.0
+    da = dst[..., 3] / 255.0 * (1 - sa)
+    out_a = sa + da
+    out = np.empty(dst.shape, np.uint8)
+    out[..., :3] = np.rint((src * sa + dst[..., :3] * da[..., None]) / out_a[..., None])
+    out[..., 3] = np.rint(out_a * 255)
+    return out.view(np.uint32).reshape(pixels.shape)
+
+def colorMatch(pixels, target, tolerance=0): # bool mask of pixels within tolerance of target on every channel
+    if tolerance <= 0:
+        return pixels == target
+    channels = pixels.view(np.uint8).reshape(pixels.shape + (4,)).astype(np.int16)
+    target_channels = np.array([(target >> shift) & 0xFF for shift in (0, 8, 16, 24)], np.int16)
+    return np.abs(channels - target_channels).max(axis=2) <= tolerance
+
+def floodMask(pixels, x, y, tolerance=0, contiguous=True, palette=None): # scanline fill over horizontal runs of matching pixels
+    if palette is None:
+        match = colorMatch(pixels, pixels[y, x], tolerance)
+    else: # pixels are indices, match the palette once and look the result up
+        table = np.array(palette, np.uint32)
+        match = colorMatch(table[None], table[pixels[y, x]], tolerance)[0][pixels]
+    if not contiguous:
+        return match
+
+    height, width = match.shape
+    padded = np.zeros((height, width + 2), np.int8)
+    padded[:, 1:-1] = match
+    edges = np.diff(padded, axis=1)
+    run_rows, run_starts = np.nonzero(edges == 1)
+    run_ends = np.nonzero(edges == -1)[1] # exclusive, paired with run_starts in row-major order
+    row_index = np.searchsorted(run_rows, np.arange(height + 1)).tolist()
+    run_starts = run_starts.tolist()
+    run_ends = run_ends.tolist()
+
+    lo, hi = row_index[y], row_index[y + 1]
+    seed = bisect_right(run_starts, x, lo, hi) - 1
+    mask = np.zeros_like(match)
+    visited = {seed}
+    stack = [(seed, y)]
+    while stack:
+        run, row = stack.pop()
+        start, end = run_starts[run], run_ends[run]
+        mask[row, start:end] = True
+        for next_row in (row - 1, row + 1): # runs overlapping this one in the rows above and below
+            if not 0 <= next_row < height:
+                continue
+            lo, hi = row_index[next_row], row_index[next_row + 1]
+            first = bisect_right(run_ends, start, lo, hi)
+            last = bisect_left(run_starts, end, lo, hi)
+            for next_run in range(first, last):
+                if next_run not in visited:
+                    visited.add(next_run)
+                    stack.append((next_run, next_row))
+    return mask
+
+def lineCells(x1, y1, x2, y2): # Bresenham's algorithm
+    dx = abs(x2 - x1)
+    dy = abs(y2 - y1)
+    sx = 1 if x1 < x2 else -1
+    sy = 1 if y1 < y2 else -1
+    err = dx - dy
+
+    cells = []
+    while True:
+        cells.append((x1, y1))
+        if x1 == x2 and y1 == y2:
+            break
+        e2 = err * 2
+        if e2 > -dy:
+            err -= dy
+            x1 += sx
+        if e2 < dx:
+            err += dx
+            y1 += sy
+    return cells
+
+def rectangleCells(x1, y1, x2, y2):
+    x1, x2 = min(x1, x2), max(x1, x2)
+    y1, y2 = min(y1, y2), max(y1, y2)
+
+    cells = []
+    for x in range(x1, x2 + 1):
+        cells.append((x, y1))
+        cells.append((x, y2))
+
+    for y in range(y1 + 1, y2):
+        cells.append((x1, y))
+        cells.append((x2, y))
+    return cells
+
+def ellipseCells(x1, y1, x2, y2): # midpoint algorithm
+    x1, x2 = min(x1, x2), max(x1, x2)
+    y1, y2 = min(y1, y2), max(y1, y2)
+
+    rx = (x2 - x1) // 2
+    ry = (y2 - y1) // 2
+    cx = x1 + rx
+    cy = y1 + ry
+
+    cells = []
+    x, y = 0, ry
+    dx, dy = 0, 2 * rx * rx * y
+    p1 = ry * ry - (rx * rx * ry) + (0.25 * rx * rx)
+    while dx < dy:
+        ellipseQuadrantCells(cells, cx, cy, x, y)
+        x += 1
+        dx += 2 * ry * ry
+        if p1 < 0:
+            p1 += dx + ry * ry
+        else:
+            y -= 1
+            dy -= 2 * rx * rx
+            p1 += dx - dy + ry * ry
+
+    p2 = (ry * ry) * (x + 0.5) ** 2 + (rx * rx) * (y - 1) ** 2 - (rx * rx * ry * ry)
+    while y >= 0:
+        ellipseQuadrantCells(cells, cx, cy, x, y)
+        y -= 1
+        dy -= 2 * rx * rx
+        if p2 > 0:
+            p2 += rx * rx - dy
+        else:
+            x += 1
+            dx += 2 * ry * ry
+            p2 += dx - dy + rx * rx
+    return cells
+
+def ellipseQuadrantCells(cells, cx, cy, x, y):
+    cells.append((cx + x, cy + y))
+    cells.append((cx - x, cy + y))
+    cells.append((cx + x, cy - y))
+    cells.append((cx - x, cy - y))
+
+def filledCells(outline, x1, y1, x2, y2): # (left, top, mask) of the cells between an outline's ends on every row
+    cells = np.array(outline(x1, y1, x2, y2), np.int64).reshape(-1, 2)
+    left, top = cells.min(axis=0)
+    xs, ys = cells[:, 0] - left, cells[:, 1] - top
+    height = ys.max() + 1
+    starts = np.full(height, xs.max(), np.int64)
+    ends = np.zeros(height, np.int64)
+    np.minimum.at(starts, ys, xs)
+    np.maximum.at(ends, ys, xs)
+    columns = np.arange(xs.max() + 1)
+    return left, top, (columns >= starts[:, None]) & (columns <= ends[:, None])
+
+shape_rasterizers = {
+    "line": lineCells,
+    "rectangle": rectangleCells,
+    "ellipse": ellipseCells,
+}
+
+filled_shapes = {
+    "filled rectangle": rectangleCells,
+    "filled ellipse": ellipseCells,
+}
+
+brush_masks = {} # size -> square stamp and the (row, column) of each of its cells, built once per size
+
+def brushMask(size):
+    if size not in brush_masks:
+        brush = np.ones((size, size), bool)
+        brush_masks[size] = brush, np.argwhere(brush)
+    return brush_masks[size]
+
+def stampMask(cells, size=1): # (left, top, mask) covered by a brush stamp at every cell, overlaps counted once
+    brush, offsets = brushMask(size)
+    xs = [x for x, _ in cells]
+    ys = [y for _, y in cells]
+    left, top = min(xs), min(ys)
+    mask = np.zeros((max(ys) - top + size, max(xs) - left + size), bool)
+    if len(cells) < 64: # few stamps, slicing them in is cheaper than building index arrays
+        for x, y in zip(xs, ys):
+            mask[y - top:y - top + size, x - left:x - left + size] |= brush
+    else: # every covered cell set in one scatter
+        mask[(np.array(ys) - top)[:, None] + offsets[:, 0], (np.array(xs) - left)[:, None] + offsets[:, 1]] = True
+    return left, top, mask
+
+def maskImage(mask, color): # ARGB32 image of mask, color where set and transparent elsewhere
+    pixels = np.where(mask, np.uint32(color), np.uint32(0))
+    height, width = mask.shape
+    return QImage(pixels.data, width, height, width * 4, QImage.Format_ARGB32).copy() # detach from pixels
+
+def shapeMask(shape, x1, y1, x2, y2): # (left, top, mask) of a shape's cells
+    if shape in filled_shapes:
+        return filledCells(filled_shapes[shape], x1, y1, x2, y2)
+    return stampMask(shape_rasterizers[shape](x1, y1, x2, y2))
+
+def shapeRect(x1, y1, x2, y2): # cells a shape between the two corners can touch
+    return QRect(QPoint(x1, y1), QPoint(x2, y2)).normalized().adjusted(-1, -1, 1, 1)
+
+class Layer: # pixels live in TILE x TILE images, allocated the first time something is written to them
+    TILE = 64
+
+    def __init__(self, width, height, name="Layer", palette=None):
+        self.width = width
+        self.height = height
+        self.palette = palette # colour table shared by every layer in indexed mode, None for ARGB32 pixels
+        self.dtype = np.uint32 if palette is None else np.uint8
+        self.tiles = {} # (tx, ty) -> ARGB32 or Indexed8 QImage, clipped at the right and bottom edges
+        self.unsaved = set() # tiles written since the last project save
+        self.uncounted = set() # tiles written since their pixel values were last counted
+        self.counts = {} # (tx, ty) -> {pixel value: cells}, per tile
+        self.totals = {} # pixel value -> cells over the whole layer, the sum of counts
+        self.name = name
+        self.visible = True
+        self.opacity = 255
+        self.blend_mode = "Normal"
+
+    @classmethod
+    def fromImage(cls, image, name="Layer", palette=None):
+        layer = cls(image.width(), image.height(), name, palette)
+        layer.setImage(image)
+        return layer
+
+    def converted(self, palette): # copy in the other pixel format, indices into palette or ARGB32 with None
+        layer = Layer.fromImage(self.toImage(), self.name, palette)
+        layer.copyProps(self)
+        return layer
+
+    def copyProps(self, layer):
+        self.visible = layer.visible
+        self.opacity = layer.opacity
+        self.blend_mode = layer.blend_mode
+
+    def setImage(self, image): # replace every pixel, fully transparent tiles are not kept
+        self.tiles = {}
+        image = image.convertToFormat(QImage.Format_ARGB32) # keep a reference, the array is a view into it
+        pixels = imageArray(image)
+        self.write(0, 0, pixels if self.palette is None else paletteIndices(pixels, self.palette))
+
+    def tile(self, tx, ty, create=False):
+        image = self.tiles.get((tx, ty))
+        if image is None and create:
+            size = self.tileRect(tx, ty).size()
+            if self.palette is None:
+                image = QImage(size, QImage.Format_ARGB32)
+                image.fill(Qt.transparent)
+            else:
+                image = QImage(size, QImage.Format_Indexed8)
+                image.setColorTable(self.palette)
+                image.fill(0)
+            self.tiles[(tx, ty)] = image
+        return image
+
+    def touch(self, tx, ty): # a tile's pixels were written
+        self.unsaved.add((tx, ty))
+        self.uncounted.add((tx, ty))
+
+    def staleCounts(self): # tiles whose counts the next tileCounts call has to redo
+        return self.uncounted | (self.tiles.keys() - self.counts.keys()) | (self.counts.keys() - self.tiles.keys())
+
+    def tileCounts(self): # counts, bringing only the tiles written since the last call up to date
+        for key in self.staleCounts():
+            for value, count in self.counts.pop(key, {}).items():
+                self.totals[value] -= count
+                if not self.totals[value]:
+                    del self.totals[value]
+            image = self.tiles.get(key)
+            if image is not None:
+                values, counts = np.unique(imageArray(image, writable=False), return_counts=True)
+                self.counts[key] = dict(zip(values.tolist(), counts.tolist()))
+                for value, count in self.counts[key].items():
+                    self.totals[value] = self.totals.get(value, 0) + count
+        self.uncounted = set()
+        return self.counts
+
+    def tileRect(self, tx, ty): # cells covered by a tile
+        tile = self.TILE
+        return QRect(tx * tile, ty * tile, tile, tile).intersected(QRect(0, 0, self.width, self.height))
+
+    def tileKeys(self, x, y, w, h): # tiles overlapping a cell rect, clipped to the layer
+        tile = self.TILE
+        left, top = max(0, x), max(0, y)
+        right, bottom = min(x + w, self.width), min(y + h, self.height)
+        if left >= right or top >= bottom:
+            return []
+        return [(tx, ty) for ty in range(top // tile, (bottom - 1) // tile + 1)
+                for tx in range(left // tile, (right - 1) // tile + 1)]
+
+    def read(self, x, y, w, h): # copy of a cell rect, transparent where no tile is allocated
+        pixels = np.zeros((h, w), self.dtype)
+        for tx, ty in self.tileKeys(x, y, w, h):
+            image = self.tiles.get((tx, ty))
+            if image is not None:
+                area = self.tileRect(tx, ty).intersected(QRect(x, y, w, h))
+                ox, oy = area.x() - tx * self.TILE, area.y() - ty * self.TILE
+                pixels[area.y() - y:area.bottom() + 1 - y, area.x() - x:area.right() + 1 - x] = \
+                    imageArray(image, writable=False)[oy:oy + area.height(), ox:ox + area.width()]
+        return pixels
+
+    def write(self, x, y, pixels): # copy an array into the tiles, allocating only those that get visible pixels
+        h, w = pixels.shape
+        for tx, ty in self.tileKeys(x, y, w, h):
+            area = self.tileRect(tx, ty).intersected(QRect(x, y, w, h))
+            block = pixels[area.y() - y:area.bottom() + 1 - y, area.x() - x:area.right() + 1 - x]
+            image = self.tile(tx, ty, create=bool(block.any()))
+            if image is not None:
+                ox, oy = area.x() - tx * self.TILE, area.y() - ty * self.TILE
+                imageArray(image)[oy:oy + area.height(), ox:ox + area.width()] = block
+                self.touch(tx, ty)
+
+    def toImage(self):
+        image = QImage(self.width, self.height, QImage.Format_ARGB32)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        for (tx, ty), tile in self.tiles.items():
+            painter.drawImage(tx * self.TILE, ty * self.TILE, tile)
+        painter.end()
+        return image
+
+class Region: # cells of a layer sharing its tiles, Qt copies a tile only once either side writes to it
+    def __init__(self, layer, rect, mask=None):
+        self.rect = QRect(rect)
+        self.mask = mask # bool array over rect, cells outside it are left out, None keeps every cell
+        self.palette = None if layer.palette is None else list(layer.palette)
+        self.source = Layer(layer.width, layer.height, layer.name, self.palette)
+        self.source.tiles = {key: QImage(layer.tiles[key]) for key in layer.tileKeys(*rect.getRect()) if key in layer.tiles}
+
+    def pixels(self, palette=None): # copy of the cells, as indices into palette or ARGB32 with None
+        pixels = self.source.read(*self.rect.getRect())
+        if self.palette != palette:
+            if self.palette is not None:
+                pixels = np.array(self.palette, np.uint32)[pixels]
+            if palette is not None:
+                pixels = paletteIndices(pixels, palette)
+        if self.mask is not None:
+            pixels[~self.mask] = 0 # transparent in both pixel formats
+        return pixels
+
+    def toImage(self):
+        image = QImage(self.rect.width(), self.rect.height(), QImage.Format_ARGB32)
+        imageArray(image)[:] = self.pixels()
+        return image
+
+class PixelCanvas:
+    HISTORY_TILE = 16 # undo entries store the touched tiles of this size, must divide Layer.TILE
+    HISTORY_BUDGET = 64 * 1024 * 1024 # bytes kept across the undo and redo stacks
+
+    def __init__(self, grid_size=default_grid_size):
+        self.undo_stack = deque()
+        self.redo_stack = deque()
+        self.history_bytes = 0
+        self.history_budget = self.HISTORY_BUDGET
+        self.pending_tiles = None # tiles saved by the operation in progress
+        self.covered = None # (tx, ty) -> bool mask of cells the operation in progress has blended, each is blended once
+        self.dirty_rect = QRect() # cells written since the last takeDirty
+        self.clipboard = None # Region last copied or cut
+        self.clear(grid_size)
+
+    def clear(self, width, height=None):
+        self.width = width
+        self.height = height or width
+        self.palette = None # ARGB32 pixels until setIndexed
+        self.layers = [Layer(self.width, self.height, "Layer 1")] # bottom to top
+        self.active = 0
+        self.clearHistory() # tiles of the old grid no longer apply
+        self.invalidateComposite()
+
+    def load(self, image):
+        self.loadLayers([Layer.fromImage(image, "Layer 1")])
+
+    def loadLayers(self, layers, active=0): # replace the whole stack, e.g. from a project file
+        self.width = layers[0].width
+        self.height = layers[0].height
+        self.palette = layers[0].palette
+        self.layers = layers
+        self.active = active
+        self.clearHistory()
+        self.invalidateComposite()
+
+    def activeLayer(self): # every drawing operation writes to this layer
+        return self.layers[self.active]
+
+    def addLayer(self, name=None): # new blank layer above the active one, which becomes active
+        self.layers.insert(self.active + 1, Layer(self.width, self.height, name or f"Layer {len(self.layers) + 1}", self.palette))
+        self.active += 1
+        self.invalidateComposite()
+        return self.active
+
+    def removeLayer(self, index):
+        if len(self.layers) == 1:
+            return
+        self.commitState()
+        self.forgetLayer(self.layers.pop(index))
+        self.active = min(self.active if self.active < index else self.active - 1, len(self.layers) - 1)
+        self.active = max(self.active, 0)
+        self.invalidateComposite()
+
+    def moveLayer(self, index, new_index):
+        if not 0 <= new_index < len(self.layers):
+            return
+        active_layer = self.activeLayer()
+        self.layers.insert(new_index, self.layers.pop(index))
+        self.active = self.layers.index(active_layer)
+        self.invalidateComposite()
+
+    def setActiveLayer(self, index):
+        if index != self.active:
+            self.commitState()
+            self.active = index
+            self.invalidateComposite() # the cached stacks below and above change
+
+    def setLayerVisible(self, index, visible):
+        self.layers[index].visible = visible
+        self.invalidateComposite()
+
+    def setLayerOpacity(self, index, opacity):
+        self.layers[index].opacity = opacity
+        self.invalidateComposite()
+
+    def setLayerBlend(self, index, mode):
+        self.layers[index].blend_mode = mode
+        self.invalidateComposite()
+
+    def setIndexed(self, palette, layers=None): # every layer to indices into palette (entry 0 transparent), or back to ARGB32 with None
+        self.commitState() # layers already converted with Layer.converted, e.g. on a worker, can be passed in
+        palette = None if palette is None else list(palette)
+        if layers is None:
+            layers = [layer.converted(palette) for layer in self.layers]
+        self.loadLayers(layers, self.active) # undo tiles of the other pixel format no longer apply
+
+    def setPaletteColor(self, index, color): # recolours every pixel using the entry through the tiles' colour tables
+        self.palette[index] = color
+        for layer in self.layers:
+            for image in layer.tiles.values():
+                image.setColor(index, color)
+        self.invalidateComposite()
+
+    def colorIndex(self, color): # palette entry for a colour, added while there is room, else the nearest one
+        if color >> 24 == 0:
+            return 0
+        if color in self.palette[1:]:
+            return self.palette.index(color, 1)
+        if len(self.palette) < 256:
+            self.palette.append(color)
+            for layer in self.layers:
+                for image in layer.tiles.values():
+                    image.setColorTable(self.palette)
+            return len(self.palette) - 1
+        return int(paletteIndices(np.array([color], np.uint32), self.palette)[0])
+
+    def invalidateComposite(self): # drop the cached stacks, every tile is recomposited on next use
+        self.below = {} # (tx, ty) -> flattened layers under the active one
+        self.above = {} # same for the layers over it, when they can be flattened ahead of time
+        self.composite = {}
+        above = [layer for layer in self.layers[self.active + 1:] if layer.visible]
+        self.above_cached = all(layer.blend_mode == "Normal" for layer in above) # source-over is associative
+        self.markDirty(0, 0, self.width, self.height)
+
+    def pixelBytes(self): # memory held by layer tiles and the cached stacks
+        images = [image for layer in self.layers for image in layer.tiles.values()]
+        images += [image for cache in (self.below, self.above, self.composite) for image in cache.values() if image is not None]
+        return sum(image.sizeInBytes() for image in images)
+
+    def drawLayer(self, painter, layer, tx, ty): # one tile of a layer, painter origin at the tile
+        image = layer.tiles.get((tx, ty))
+        if image is not None and layer.visible and layer.opacity:
+            painter.setCompositionMode(blend_modes[layer.blend_mode])
+            painter.setOpacity(layer.opacity / 255)
+            painter.drawImage(0, 0, image)
+
+    def flattenTile(self, layers, tx, ty): # visible layers blended bottom to top, None if nothing is there
+        if not any((tx, ty) in layer.tiles for layer in layers if layer.visible and layer.opacity):
+            return None
+        image = QImage(self.activeLayer().tileRect(tx, ty).size(), QImage.Format_ARGB32_Premultiplied)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        for layer in layers:
+            self.drawLayer(painter, layer, tx, ty)
+        painter.end()
+        return image
+
+    def cachedStack(self, cache, layers, tx, ty):
+        if (tx, ty) not in cache:
+            cache[(tx, ty)] = self.flattenTile(layers, tx, ty)
+        return cache[(tx, ty)]
+
+    def compositeTile(self, tx, ty): # all visible layers over one tile, None where every layer is empty
+        if (tx, ty) in self.composite:
+            return self.composite[(tx, ty)]
+        if not self.above_cached:
+            image = self.flattenTile(self.layers, tx, ty)
+        else:
+            below = self.cachedStack(self.below, self.layers[:self.active], tx, ty)
+            above = self.cachedStack(self.above, self.layers[self.active + 1:], tx, ty)
+            layer = self.activeLayer()
+            image = None
+            if below is not None or above is not None or (tx, ty) in layer.tiles:
+                image = QImage(layer.tileRect(tx, ty).size(), QImage.Format_ARGB32_Premultiplied)
+                image.fill(Qt.transparent)
+                painter = QPainter(image)
+                if below is not None:
+                    painter.drawImage(0, 0, below)
+                self.drawLayer(painter, layer, tx, ty)
+                if above is not None:
+                    painter.setCompositionMode(QPainter.CompositionMode_SourceOver)
+                    painter.setOpacity(1)
+                    painter.drawImage(0, 0, above)
+                painter.end()
+        self.composite[(tx, ty)] = image
+        return image
+
+    def flatten(self): # the composite as a plain ARGB32 image, for saving
+        image = QImage(self.width, self.height, QImage.Format_ARGB32)
+        image.fill(Qt.transparent)
+        painter = QPainter(image)
+        painter.setCompositionMode(QPainter.CompositionMode_Source)
+        tile = Layer.TILE
+        for tx, ty in self.activeLayer().tileKeys(0, 0, self.width, self.height):
+            composite = self.compositeTile(tx, ty)
+            if composite is not None:
+                painter.drawImage(tx * tile, ty * tile, composite)
+        painter.end()
+        return image
+
+    def contains(self, x, y):
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def markDirty(self, x, y, w=1, h=1):
+        self.dirty_rect = self.dirty_rect.united(QRect(x, y, w, h))
+        if self.composite:
+            for key in self.activeLayer().tileKeys(x, y, w, h):
+                self.composite.pop(key, None)
+
+    def readTiles(self, layer, keys): # history tiles of one layer, read in one pass over their bounding box
+        tile = self.HISTORY_TILE
+        left = min(tx for tx, ty in keys) * tile
+        top = min(ty for tx, ty in keys) * tile
+        right = min((max(tx for tx, ty in keys) + 1) * tile, self.width)
+        bottom = min((max(ty for tx, ty in keys) + 1) * tile, self.height)
+        pixels = layer.read(left, top, right - left, bottom - top)
+        return {(tx, ty): pixels[ty * tile - top:(ty + 1) * tile - top, tx * tile - left:(tx + 1) * tile - left].copy()
+                for tx, ty in keys}
+
+    def markChanged(self, x, y, w=1, h=1): # cells about to be written: keep their tiles for undo, then mark dirty
+        if self.pending_tiles is not None:
+            tile = self.HISTORY_TILE
+            layer = self.activeLayer()
+            keys = [(tx, ty) for ty in range(max(0, y) // tile, (min(y + h, self.height) - 1) // tile + 1)
+                    for tx in range(max(0, x) // tile, (min(x + w, self.width) - 1) // tile + 1)
+                    if (layer, tx, ty) not in self.pending_tiles]
+            if keys:
+                for (tx, ty), before in self.readTiles(layer, keys).items():
+                    self.pending_tiles[(layer, tx, ty)] = before
+        self.markDirty(x, y, w, h)
+
+    def takeDirty(self): # cells written since the last call
+        rect = self.dirty_rect
+        self.dirty_rect = QRect()
+        return rect
+
+    def paintMask(self, left, top, mask, color, erase=False): # one write per tile for every cell set in mask
+        layer = self.activeLayer()
+        if erase:
+            color = 0 # transparent in both pixel formats
+        elif self.palette is not None:
+            color = self.colorIndex(color)
+        bounds = QRect(left, top, mask.shape[1], mask.shape[0]).intersected(QRect(0, 0, self.width, self.height))
+        if bounds.isEmpty():
+            return
+        mask = mask[bounds.y() - top:bounds.bottom() + 1 - top, bounds.x() - left:bounds.right() + 1 - left]
+        left, top = bounds.x(), bounds.y()
+        tile = Layer.TILE
+        keys = layer.tileKeys(left, top, bounds.width(), bounds.height())
+        if len(keys) > 4: # find the tiles with any cell set in one pass over the mask, not one test per tile
+            ox, oy = left % tile, top % tile
+            rows, columns = -(-(oy + bounds.height()) // tile), -(-(ox + bounds.width()) // tile)
+            aligned = np.zeros((rows * tile, columns * tile), bool)
+            aligned[oy:oy + bounds.height(), ox:ox + bounds.width()] = mask
+            occupied = aligned.reshape(rows, tile, columns, tile).any(axis=(1, 3))
+            keys = [(left // tile + column, top // tile + row) for row, column in np.argwhere(occupied).tolist()]
+        for tx, ty in keys:
+            area = layer.tileRect(tx, ty).intersected(bounds)
+            block = mask[area.y() - top:area.bottom() + 1 - top, area.x() - left:area.right() + 1 - left]
+            if not block.any():
+                continue
+            image = layer.tile(tx, ty, create=not erase)
+            if image is None: # nothing to erase
+                continue
+            layer.touch(tx, ty)
+            ox, oy = area.x() - tx * tile, area.y() - ty * tile
+            pixels = imageArray(image)[oy:oy + area.height(), ox:ox + area.width()]
+            if erase or self.palette is not None or color >> 24 == 255: # nothing to blend
+                pixels[block] = color
+                continue
+            if self.covered is not None: # a stroke drawn in several batches meets itself where they join
+                seen = self.covered.setdefault((tx, ty), np.zeros((tile, tile), bool))[oy:oy + area.height(), ox:ox + area.width()]
+                block = block & ~seen
+                seen |= block
+            pixels[block] = blendOver(pixels[block], color)
+
+    def stroke(self, x1, y1, x2, y2, color, size=1, erase=False): # square stamps of size cells along a line
+        self.markChanged(min(x1, x2), min(y1, y2), abs(x2 - x1) + size, abs(y2 - y1) + size)
+        self.paintMask(*stampMask(lineCells(x1, y1, x2, y2), size), color, erase)
+
+    def strokePath(self, points, color, size=1, erase=False): # connected lines through every point, written as one mask
+        cells = [points[0]]
+        for (x1, y1), (x2, y2) in zip(points, points[1:]):
+            cells += lineCells(x1, y1, x2, y2)[1:]
+        xs = [x for x, _ in points]
+        ys = [y for _, y in points]
+        self.markChanged(min(xs), min(ys), max(xs) - min(xs) + size, max(ys) - min(ys) + size)
+        self.paintMask(*stampMask(cells, size), color, erase)
+
+    def fill(self, x, y, color, tolerance=0, contiguous=True):
+        if not self.contains(x, y):
+            return
+        layer = self.activeLayer()
+        pixels = layer.read(0, 0, self.width, self.height)
+        if self.palette is not None:
+            color = self.colorIndex(color)
+        if tolerance == 0 and pixels[y, x] == color:
+            return
+        mask = floodMask(pixels, x, y, tolerance, contiguous, self.palette)
+        values = color if self.palette is not None else blendOver(pixels[mask], color) # indices replace, colours blend
+        self.writeMasked(pixels, mask, values) # single write for the whole region
+
+    def writeMasked(self, pixels, mask, values): # store values at mask, only the bounding box goes back to the tiles
+        rows = np.flatnonzero(mask.any(axis=1))
+        cols = np.flatnonzero(mask.any(axis=0))
+        left, top = int(cols[0]), int(rows[0])
+        right, bottom = int(cols[-1]) + 1, int(rows[-1]) + 1
+        self.markChanged(left, top, right - left, bottom - top)
+        pixels[mask] = values
+        self.activeLayer().write(left, top, pixels[top:bottom, left:right])
+
+    def remap(self, mapping): # {source argb: target argb}, every matching pixel replaced in one pass
+        if not mapping:
+            return
+        if self.palette is not None: # only the palette entries change, O(palette) whatever the canvas size
+            for index, color in enumerate(self.palette[1:], 1):
+                if color in mapping:
+                    self.setPaletteColor(index, mapping[color])
+            return
+        layer = self.activeLayer()
+        sources = np.array(sorted(mapping), np.uint32)
+        targets = np.array([mapping[source] for source in sorted(mapping)], np.uint32)
+        # the colour index skips tiles without a source colour, but counting a mostly uncounted layer costs far more than one direct pass
+        warm = len(layer.staleCounts()) * 2 <= len(layer.tiles)
+        for tx, ty in self.tilesWith(*mapping) if warm else list(layer.tiles):
+            pixels = imageArray(layer.tiles[(tx, ty)])
+            index = np.searchsorted(sources, pixels).clip(0, len(sources) - 1)
+            mask = sources[index] == pixels
+            if mask.any():
+                self.markChanged(*layer.tileRect(tx, ty).getRect())
+                pixels[mask] = targets[index[mask]]
+                layer.touch(tx, ty)
+
+    def colorCounts(self): # {ARGB: cells} of the active layer, transparent cells left out, O(tiles written since the last call)
+        layer = self.activeLayer()
+        layer.tileCounts()
+        if self.palette is None:
+            return {value: count for value, count in layer.totals.items() if value >> 24}
+        counts = {}
+        for index, count in layer.totals.items():
+            if index:
+                counts[self.palette[index]] = counts.get(self.palette[index], 0) + count
+        return counts
+
+    def tilesWith(self, *colors): # active layer tiles holding any of these ARGB colours
+        values = set(colors)
+        if self.palette is not None:
+            values = {index for index, color in enumerate(self.palette) if index and color in values}
+        return [key for key, counts in self.activeLayer().tileCounts().items() if not values.isdisjoint(counts)]
+
+    def colorBounds(self, color): # cells spanned by every pixel of a colour on the active layer, empty if there are none
+        layer = self.activeLayer()
+        value = color if self.palette is None else [index for index, entry in enumerate(self.palette) if index and entry == color]
+        bounds = QRect()
+        for tx, ty in self.tilesWith(color):
+            rows, columns = np.nonzero(np.isin(imageArray(layer.tiles[(tx, ty)], writable=False), value))
+            bounds = bounds.united(QRect(tx * Layer.TILE + int(columns.min()), ty * Layer.TILE + int(rows.min()),
+                                         int(columns.max() - columns.min()) + 1, int(rows.max() - rows.min()) + 1))
+        return bounds
+
+    def colorMask(self, color, rect): # bool array over rect, set where the active layer has the colour
+        value = color if self.palette is None else [index for index, entry in enumerate(self.palette) if index and entry == color]
+        return np.isin(self.activeLayer().read(*rect.getRect()), value)
+
+    def colorAt(self, x, y): # ARGB of the visible composite at a cell, read from its cached tile
+        if not self.contains(x, y):
+            return 0
+        tile = Layer.TILE
+        image = self.compositeTile(x // tile, y // tile)
+        return 0 if image is None else image.pixelColor(x % tile, y % tile).rgba()
+
+    def clipRegion(self, rect, mask=None): # rect and its mask cut down to the canvas
+        bounds = rect.intersected(QRect(0, 0, self.width, self.height))
+        if mask is not None:
+            mask = mask[bounds.y() - rect.y():bounds.bottom() + 1 - rect.y(), bounds.x() - rect.x():bounds.right() + 1 - rect.x()].copy()
+        return bounds, mask
+
+    def copyRegion(self, rect, mask=None): # the clipboard shares the active layer's tiles instead of copying its cells
+        self.clipboard = Region(self.activeLayer(), *self.clipRegion(rect, mask))
+
+    def liftRegion(self, rect, mask=None): # cells taken off the active layer as a Region, transparent where they were
+        rect, mask = self.clipRegion(rect, mask)
+        layer = self.activeLayer()
+        region = Region(layer, rect, mask)
+        self.markChanged(*rect.getRect())
+        if mask is None:
+            layer.write(rect.x(), rect.y(), np.zeros((rect.height(), rect.width()), layer.dtype))
+        else: # only the masked cells are taken
+            pixels = layer.read(*rect.getRect())
+            pixels[mask] = 0
+            layer.write(rect.x(), rect.y(), pixels)
+        return region
+
+    def pasteRegion(self, region, x, y): # a region's visible cells written with their top left at x, y
+        pixels = region.pixels(self.palette)
+        mask = pixels != 0 if self.palette is not None else pixels >> 24 != 0
+        h, w = pixels.shape
+        layer = self.activeLayer()
+        self.markChanged(x, y, w, h)
+        layer.write(x, y, np.where(mask, pixels, layer.read(x, y, w, h)))
+
+    def layerPixels(self): # the active layer's cells as ARGB32, palette entries looked up in indexed mode
+        pixels = self.activeLayer().read(0, 0, self.width, self.height)
+        return pixels if self.palette is None else np.array(self.palette, np.uint32)[pixels]
+
+    def writePixels(self, x, y, pixels): # ARGB32 cells written to the active layer, as the nearest palette entries in indexed mode
+        if self.palette is not None:
+            pixels = paletteIndices(pixels, self.palette)
+        h, w = pixels.shape
+        self.markChanged(x, y, w, h)
+        self.activeLayer().write(x, y, pixels)
+
+    def drawShape(self, shape, x1, y1, x2, y2, color):
+        self.markChanged(*shapeRect(x1, y1, x2, y2).getRect())
+        self.paintMask(*shapeMask(shape, x1, y1, x2, y2), color)
+
+    def saveState(self): # start recording the tiles the next operation touches
+        self.commitState()
+        self.pending_tiles = {}
+        self.covered = {}
+
+    def commitState(self): # push the recorded tiles that actually changed as one undo entry
+        self.covered = None
+        if not self.pending_tiles:
+            self.pending_tiles = None
+            return
+        entry = {}
+        for layer in {layer for layer, _, _ in self.pending_tiles}:
+            keys = [(tx, ty) for key_layer, tx, ty in self.pending_tiles if key_layer is layer]
+            for (tx, ty), after in self.readTiles(layer, keys).items():
+                before = self.pending_tiles[(layer, tx, ty)]
+                if not np.array_equal(before, after):
+                    entry[(layer, tx, ty)] = before
+        self.pending_tiles = None
+        if not entry:
+            return
+        self.clearRedo()
+        self.pushHistory(self.undo_stack, entry)
+        self.trimHistory()
+
+    def historySize(self, entry):
+        return sum(tile.nbytes for tile in entry.values())
+
+    def pushHistory(self, stack, entry):
+        stack.append(entry)
+        self.history_bytes += self.historySize(entry)
+
+    def popHistory(self, stack):
+        entry = stack.pop()
+        self.history_bytes -= self.historySize(entry)
+        return entry
+
+    def clearRedo(self):
+        while self.redo_stack:
+            self.popHistory(self.redo_stack)
+
+    def trimHistory(self): # drop entries until both stacks fit the budget, the redo steps furthest from the current state go first
+        for stack in (self.redo_stack, self.undo_stack):
+            while self.history_bytes > self.history_budget and stack:
+                self.history_bytes -= self.historySize(stack.popleft())
+
+    def setHistoryBudget(self, budget):
+        self.history_budget = budget
+        self.trimHistory()
+
+    def forgetLayer(self, layer): # drop a removed layer's tiles from the history, entries left empty go too
+        for stack in (self.undo_stack, self.redo_stack):
+            entries = list(stack)
+            stack.clear()
+            for entry in entries:
+                kept = {key: tile for key, tile in entry.items() if key[0] is not layer}
+                self.history_bytes -= self.historySize(entry) - self.historySize(kept)
+                if kept:
+                    stack.append(kept)
+
+    def clearHistory(self):
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.history_bytes = 0
+        self.pending_tiles = None
+        self.covered = None
+
+    def swapTiles(self, entry): # write entry's tiles into their layers and return what they replaced
+        tile = self.HISTORY_TILE
+        replaced = {}
+        for layer in {layer for layer, _, _ in entry}:
+            keys = [(tx, ty) for key_layer, tx, ty in entry if key_layer is layer]
+            for (tx, ty), before in self.readTiles(layer, keys).items():
+                replaced[(layer, tx, ty)] = before
+                data = entry[(layer, tx, ty)]
+                layer.write(tx * tile, ty * tile, data)
+                self.markDirty(tx * tile, ty * tile, data.shape[1], data.shape[0])
+            if layer is not self.activeLayer(): # baked into the cached stack below or above
+                self.invalidateComposite()
+        return replaced
+
+    def undo(self):
+        drawing = self.pending_tiles is not None
+        self.commitState() # handles active drawing
+        if self.undo_stack:
+            entry = self.popHistory(self.undo_stack)
+            self.pushHistory(self.redo_stack, self.swapTiles(entry))
+            self.trimHistory()
+        if drawing:
+            self.pending_tiles = {}
+
+    def redo(self):
+        drawing = self.pending_tiles is not None
+        self.commitState() # handles active drawing
+        if self.redo_stack:
+            entry = self.popHistory(self.redo_stack)
+            self.pushHistory(self.undo_stack, self.swapTiles(entry))
+            self.trimHistory()
+        if drawing:
+            self.pending_tiles = {}
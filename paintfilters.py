@@ -0,0 +1,183 @@
+import numpy as np
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+from paintengine import Layer, imageArray
+from paintio import ImageJob
+from paintstats import stats
+
+"""Pixel-art filters on ARGB32 arrays: outline, drop shadow, dithering, hue shift and Scale2x/Scale3x upscaling."""
+
+bayer_matrix = np.array([[0, 8, 2, 10], [12, 4, 14, 6], [3, 11, 1, 9], [15, 7, 13, 5]], np.float32) / 16 - 15 / 32 # centred on 0
+
+def channels(pixels): # (..., 4) float view as B, G, R, A
+    return pixels.view(np.uint8).reshape(pixels.shape + (4,)).astype(np.float32)
+
+def packChannels(bgra): # inverse of channels, rounded and clipped
+    return np.ascontiguousarray(np.clip(np.rint(bgra), 0, 255).astype(np.uint8)).view(np.uint32).reshape(bgra.shape[:-1])
+
+def opaque(pixels):
+    return pixels >> 24 != 0
+
+def shifted(mask, dx, dy): # mask moved by dx, dy cells, False where nothing moved in
+    out = np.zeros_like(mask)
+    h, w = mask.shape
+    out[max(0, dy):h + min(0, dy), max(0, dx):w + min(0, dx)] = mask[max(0, -dy):h - max(0, dy), max(0, -dx):w - max(0, dx)]
+    return out
+
+def outline(pixels, color): # transparent cells next to an opaque one, on any side, get color
+    solid = opaque(pixels)
+    edge = shifted(solid, 1, 0) | shifted(solid, -1, 0) | shifted(solid, 0, 1) | shifted(solid, 0, -1)
+    return np.where(edge & ~solid, np.uint32(color), pixels)
+
+def dropShadow(pixels, color, dx=1, dy=1): # transparent cells the sprite would cover moved by dx, dy get color
+    solid = opaque(pixels)
+    return np.where(shifted(solid, dx, dy) & ~solid, np.uint32(color), pixels)
+
+def nearestColors(bgr, table): # index of the nearest palette colour for every row of bgr
+    distance = ((bgr[:, None, :] - table[None, :, :]) ** 2).sum(axis=2)
+    return distance.argmin(axis=1)
+
+def paletteTable(palette): # opaque palette entries as (colors, B G R float rows)
+    colors = np.array([color for color in palette if color >> 24], np.uint32)
+    return colors, channels(colors)[:, :3]
+
+def orderedDither(pixels, palette, x=0, y=0): # 4x4 Bayer threshold added before the nearest colour, x, y place the matrix
+    colors, table = paletteTable(palette)
+    solid = opaque(pixels)
+    if not len(colors) or not solid.any():
+        return pixels
+    h, w = pixels.shape
+    spread = 255 / max(1, round(len(colors) ** (1 / 3))) # about one step between palette colours per channel
+    rows, columns = np.ogrid[y:y + h, x:x + w]
+    bgr = channels(pixels)[..., :3] + (bayer_matrix[rows % 4, columns % 4] * spread)[..., None]
+    out = pixels.copy()
+    out[solid] = colors[nearestColors(bgr[solid], table)]
+    return out
+
+def floydSteinberg(pixels, palette): # error diffusion along anti-diagonal wavefronts, each one vectorized
+    colors, table = paletteTable(palette)
+    solid = opaque(pixels)
+    if not len(colors) or not solid.any():
+        return pixels
+    h, w = pixels.shape
+    bgr = channels(pixels)[..., :3]
+    error = np.zeros((h + 1, w + 2, 3), np.float32) # one column of padding on each side and a row below
+    out = pixels.copy()
+    for wave in range(w + 2 * (h - 1)): # cell (y, x) only takes error from cells on earlier waves x + 2y
+        ys = np.arange(max(0, (wave - w + 2) // 2), min(h - 1, wave // 2) + 1)
+        xs = wave - 2 * ys
+        keep = solid[ys, xs] # transparent cells neither take nor pass on error
+        ys, xs = ys[keep], xs[keep]
+        if not len(ys):
+            continue
+        value = bgr[ys, xs] + error[ys, xs + 1]
+        nearest = nearestColors(value, table)
+        out[ys, xs] = colors[nearest]
+        diff = value - table[nearest]
+        error[ys, xs + 2] += diff * (7 / 16)
+        error[ys + 1, xs] += diff * (3 / 16)
+        error[ys + 1, xs + 1] += diff * (5 / 16)
+        error[ys + 1, xs + 2] += diff * (1 / 16)
+    return out
+
+def hueShift(pixels, degrees): # HSV hue rotated, saturation, value and alpha kept
+    bgra = channels(pixels)
+    b, g, r = bgra[..., 0], bgra[..., 1], bgra[..., 2]
+    high = np.maximum(np.maximum(r, g), b)
+    low = np.minimum(np.minimum(r, g), b)
+    span = high - low
+    safe = np.where(span == 0, 1, span)
+    hue = np.where(high == r, (g - b) / safe % 6, np.where(high == g, (b - r) / safe + 2, (r - g) / safe + 4))
+    hue = (hue + degrees / 60) % 6
+    # every channel from the shifted hue, saturation and value
+    def channel(n):
+        k = (n + hue) % 6
+        return high - span * np.clip(np.minimum(k, 4 - k), 0, 1)
+    out = np.stack([channel(1), channel(3), channel(5), bgra[..., 3]], axis=-1)
+    return np.where(span == 0, pixels, packChannels(out))
+
+def neighbours(pixels): # every cell's 3x3 neighbourhood A..I, edges repeated
+    padded = np.pad(pixels, 1, mode="edge")
+    h, w = pixels.shape
+    return [padded[dy:dy + h, dx:dx + w] for dy in range(3) for dx in range(3)]
+
+def scale2x(pixels): # also known as EPX
+    _, b, _, d, e, f, _, h, _ = neighbours(pixels)
+    out = np.empty((pixels.shape[0] * 2, pixels.shape[1] * 2), pixels.dtype)
+    corner = (b != h) & (d != f)
+    out[0::2, 0::2] = np.where(corner & (d == b), d, e)
+    out[0::2, 1::2] = np.where(corner & (b == f), f, e)
+    out[1::2, 0::2] = np.where(corner & (d == h), d, e)
+    out[1::2, 1::2] = np.where(corner & (h == f), f, e)
+    return out
+
+def scale3x(pixels):
+    a, b, c, d, e, f, g, h, i = neighbours(pixels)
+    corner = (b != h) & (d != f)
+    db, bf, dh, hf = corner & (d == b), corner & (b == f), corner & (d == h), corner & (h == f)
+    out = np.empty((pixels.shape[0] * 3, pixels.shape[1] * 3), pixels.dtype)
+    out[0::3, 0::3] = np.where(db, d, e)
+    out[0::3, 1::3] = np.where((db & (e != c)) | (bf & (e != a)), b, e)
+    out[0::3, 2::3] = np.where(bf, f, e)
+    out[1::3, 0::3] = np.where((db & (e != g)) | (dh & (e != a)), d, e)
+    out[1::3, 1::3] = e
+    out[1::3, 2::3] = np.where((bf & (e != i)) | (hf & (e != c)), f, e)
+    out[2::3, 0::3] = np.where(dh, d, e)
+    out[2::3, 1::3] = np.where((dh & (e != i)) | (hf & (e != g)), h, e)
+    out[2::3, 2::3] = np.where(hf, f, e)
+    return out
+
+def scalePixelArt(image, scale): # Scale3x and Scale2x steps while they divide scale, nearest neighbour for the rest
+    image = image.convertToFormat(QImage.Format_ARGB32)
+    pixels = imageArray(image).copy()
+    while scale > 1 and scale % 3 == 0:
+        pixels, scale = scale3x(pixels), scale // 3
+    while scale > 1 and scale % 2 == 0:
+        pixels, scale = scale2x(pixels), scale // 2
+    result = QImage(pixels.shape[1], pixels.shape[0], QImage.Format_ARGB32)
+    imageArray(result)[:] = pixels
+    if scale > 1:
+        result = result.scaled(result.width() * scale, result.height() * scale, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+    return result
+
+# name -> (function, cells of context each tile needs around it or a function of the filter's keyword arguments giving them,
+# None when only the whole image works)
+filters = {
+    "Outline": (outline, 1),
+    "Drop shadow": (dropShadow, lambda dx=1, dy=1, **_: max(abs(dx), abs(dy))), # a cell's shadow comes from dx, dy away
+    "Ordered dither": (orderedDither, 0),
+    "Floyd-Steinberg dither": (floydSteinberg, None),
+    "Hue shift": (hueShift, 0),
+}
+
+def filterTile(pixels, name, left, top, right, bottom, halo, params): # (left, top, filtered cells) of one tile
+    function, _ = filters[name]
+    x, y = max(0, left - halo), max(0, top - halo)
+    block = pixels[y:bottom + halo, x:right + halo]
+    if not block.any():
+        return left, top, None
+    if name == "Ordered dither":
+        params = dict(params, x=x, y=y)
+    with stats.timer("filter_tile"):
+        result = function(block, **params)
+    return left, top, result[top - y:top - y + bottom - top, left - x:left - x + right - left]
+
+def filterJob(pixels, name, **params): # one task per layer tile, or a single one for filters that need the whole image
+    function, halo = filters[name]
+    if callable(halo):
+        halo = halo(**params)
+    job = ImageJob()
+    h, w = pixels.shape
+    tile = Layer.TILE if halo is not None else max(w, h)
+    for top in range(0, h, tile):
+        for left in range(0, w, tile):
+            job.submit(filterTile, pixels, name, left, top, min(left + tile, w), min(top + tile, h), halo or 0, params)
+    return job
+
+def filterResult(pixels, job): # the filtered image from a finished filterJob, raises Cancelled if it was cancelled
+    results = job.results()
+    out = pixels.copy()
+    for left, top, block in results:
+        if block is not None:
+            out[top:top + block.shape[0], left:left + block.shape[1]] = block
+    return out
@@ -0,0 +1,209 @@
+import os
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+from paintengine import imageArray
+from paintstats import stats
+
+"""Image decode/encode off the GUI thread: open, save and multi-scale export with progress and cancellation."""
+
+export_scales = [1, 2, 3, 4, 8]
+export_formats = ["png", "bmp", "jpg", "webp"]
+
+class Cancelled(Exception):
+    pass
+
+class ImageJob: # tasks on a shared pool; progress is the number finished, cancelling skips the ones not started yet
+    pool = ThreadPoolExecutor(max_workers=os.cpu_count(), thread_name_prefix="image-io")
+
+    def __init__(self, size=None):
+        self.futures = []
+        self.done = 0
+        self.size = size # bytes of the one file the job reads, progress then follows the read position
+        self.position = 0
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+
+    @property
+    def total(self):
+        return len(self.futures)
+
+    def progress(self): # (done, total)
+        return (self.position, self.size) if self.size else (self.done, self.total)
+
+    def advance(self, count):
+        with self.lock:
+            self.position += count
+
+    def submit(self, task, *args):
+        self.futures.append(self.pool.submit(self.run, task, *args))
+
+    def run(self, task, *args):
+        if self.cancelled.is_set():
+            raise Cancelled()
+        result = task(*args)
+        with self.lock:
+            self.done += 1
+        return result
+
+    def cancel(self): # reads and writes through a JobFile fail from now on, files already written are kept
+        self.cancelled.set()
+        for future in self.futures:
+            future.cancel()
+
+    def finished(self):
+        return all(future.done() for future in self.futures)
+
+    def results(self): # raises Cancelled, or the first task error
+        if self.cancelled.is_set():
+            raise Cancelled()
+        return [future.result() for future in self.futures]
+
+class JobFile(QFile): # a file whose reads and writes fail once its job is cancelled, so a running decode or encode stops
+    def __init__(self, path, job):
+        super().__init__(path)
+        self.job = job
+
+    def readData(self, maxlen):
+        if self.job.cancelled.is_set():
+            return None # read error
+        data = super().readData(maxlen)
+        if data:
+            self.job.advance(len(data))
+        return data
+
+    def writeData(self, data):
+        if self.job.cancelled.is_set():
+            return -1
+        return super().writeData(data)
+
+def readImage(path, job=None): # through a JobFile when there is a job to cancel it
+    device = None
+    if job:
+        device = JobFile(path, job)
+        if not device.open(QIODevice.ReadOnly):
+            raise ValueError(device.errorString())
+    reader = QImageReader(device) if device else QImageReader(path)
+    with stats.timer("image_read"):
+        image = reader.read()
+    if job and job.cancelled.is_set(): # the decoder may return what it had so far
+        raise Cancelled()
+    if image.isNull():
+        raise ValueError(reader.errorString())
+    return image
+
+def upscale(image, scale, scaler=None): # nearest neighbour unless a scaler(image, scale) is given
+    if scale > 1 and scaler:
+        return scaler(image, scale)
+    if scale > 1:
+        return image.scaled(image.width() * scale, image.height() * scale, Qt.IgnoreAspectRatio, Qt.FastTransformation)
+    return image
+
+def writeImage(image, path, scale=1, scaler=None, job=None): # upscale, then encode
+    image = upscale(image, scale, scaler)
+    with stats.timer("image_write"):
+        if job: # encoded next to path and renamed, a cancelled save leaves the old file as it was
+            device = JobFile(path + ".part", job)
+            writer = QImageWriter(device, os.path.splitext(path)[1][1:].lower().encode())
+            saved = device.open(QIODevice.WriteOnly) and writer.write(image)
+            device.close()
+            if saved:
+                os.replace(device.fileName(), path)
+            elif device.exists():
+                device.remove()
+        else:
+            saved = image.save(path)
+    if job and job.cancelled.is_set():
+        raise Cancelled()
+    if not saved:
+        raise IOError(f"could not write {path}")
+    return path
+
+def exportPaths(path, scales, formats): # sprite.png -> sprite.png, sprite@2x.png, sprite.bmp, ...
+    base = os.path.splitext(path)[0]
+    return [(f"{base}{'' if scale == 1 else f'@{scale}x'}.{image_format}", scale)
+            for scale in scales for image_format in formats]
+
+def downscale(image, size): # longest side at most size cells, averaged down, aspect ratio kept
+    if max(image.width(), image.height()) <= size:
+        return image
+    return image.scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+def medianCut(image, colors): # (image, palette) with at most colors opaque ARGB entries, most used first
+    image = image.convertToFormat(QImage.Format_ARGB32)
+    pixels = imageArray(image)
+    opaque = pixels >> 24 >= 128 # pixel art has no partial alpha, the rest becomes transparent
+    unique, inverse, counts = np.unique(pixels[opaque] | np.uint32(0xFF000000), return_inverse=True, return_counts=True)
+    channels = unique.view(np.uint8).reshape(-1, 4)[:, :3].astype(np.int64) # B, G, R
+    boxes = [np.arange(len(unique))] if len(unique) else []
+    ranges = [np.ptp(channels, axis=0)] if len(unique) else []
+    while 0 < len(boxes) < colors: # split the box with the widest channel at its population median
+        best = max(range(len(boxes)), key=lambda i: ranges[i].max())
+        if ranges[best].max() == 0:
+            break
+        box = boxes[best]
+        order = box[np.argsort(channels[box, ranges[best].argmax()], kind="stable")]
+        population = np.cumsum(counts[order])
+        split = int(np.clip(np.searchsorted(population, population[-1] / 2) + 1, 1, len(order) - 1))
+        halves = [order[:split], order[split:]]
+        boxes[best:best + 1] = halves
+        ranges[best:best + 1] = [np.ptp(channels[half], axis=0) for half in halves]
+    weights = [counts[box].sum() for box in boxes]
+    boxes = [boxes[i] for i in np.argsort(weights)[::-1]]
+    lookup = np.zeros(len(unique), np.uint32)
+    palette = []
+    for box in boxes: # count-weighted mean colour of each box
+        b, g, r = (channels[box] * counts[box, None]).sum(axis=0) // counts[box].sum()
+        color = 0xFF000000 | int(r) << 16 | int(g) << 8 | int(b)
+        lookup[box] = color
+        palette.append(color)
+    result = QImage(image.width(), image.height(), QImage.Format_ARGB32)
+    out = imageArray(result)
+    out[:] = 0
+    out[opaque] = lookup[inverse.ravel()]
+    return result, palette
+
+def importImage(path, size, colors, job=None):
+    image = readImage(path, job)
+    with stats.timer("image_import"):
+        return medianCut(downscale(image, size), colors)
+
+def fileSize(path): # None for a missing file, its job then fails with the reader's error
+    return os.path.getsize(path) if os.path.isfile(path) else None
+
+def openJob(path): # progress follows the bytes the decoder has read
+    job = ImageJob(fileSize(path))
+    job.submit(readImage, path, job)
+    return job
+
+def importJob(path, size, colors): # decoded, downscaled and quantized on a worker, results in (image, palette)
+    job = ImageJob(fileSize(path))
+    job.submit(importImage, path, size, colors, job)
+    return job
+
+def indexedJob(layers, palette): # one task per layer, results are the converted layers for PixelCanvas.setIndexed
+    job = ImageJob()
+    for layer in layers:
+        job.submit(layer.converted, palette)
+    return job
+
+def saveJob(image, path): # image must not be painted on while the job runs, pass a copy; the encoded size is unknown, so no progress
+    job = ImageJob()
+    job.submit(writeImage, image, path, 1, None, job)
+    return job
+
+def exportScaled(image, path, scale, scaler, job, scaled): # the first task of a scale upscales, the other formats wait and reuse it
+    lock, images = scaled[scale]
+    with lock:
+        if not images:
+            images.append(upscale(image, scale, scaler))
+    return writeImage(images[0], path, 1, None, job)
+
+def exportJob(image, path, scales, formats, scaler=None): # every scale and format from the one buffer, encoded in parallel
+    job = ImageJob()
+    scaled = {scale: (threading.Lock(), []) for scale in scales} # each scale is built once, however many formats use it
+    for out_path, scale in exportPaths(path, scales, formats):
+        job.submit(exportScaled, image, out_path, scale, scaler, job, scaled)
+    return job
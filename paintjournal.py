@@ -0,0 +1,324 @@
+import os
+import sys
+import time
+import zlib
+import struct
+import argparse
+import threading
+import numpy as np
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+from paintengine import PixelCanvas, imageArray, blend_modes
+from paintanim import Timeline
+from paintstats import stats
+
+"""Append-only binary journal of canvas input, with deterministic replay for crash recovery and benchmarks."""
+
+shape_names = ["line", "rectangle", "ellipse", "filled rectangle", "filled ellipse"]
+blend_names = list(blend_modes)
+
+class Journal:
+    MAGIC = b"ITPJ\x02"
+    NEW = 1 # width, height
+    LOAD = 2 # width, height, zlib length + compressed ARGB32 pixels, as a single layer
+    TOOL = 3 # drawing mode from setDrawingMode
+    COLOR = 4 # pen colour as ARGB, opacity included
+    PEN_SIZE = 5
+    BEGIN = 6 # mouse press, opens a history entry
+    STROKE = 7 # x1, y1, x2, y2, erase
+    FILL = 8 # x, y, tolerance, contiguous
+    SHAPE = 9 # shape index, x1, y1, x2, y2
+    COMMIT = 10 # mouse release, closes the history entry
+    UNDO = 11
+    REDO = 12
+    CLOSE = 13 # clean shutdown
+    LAYER_ADD = 14 # blank layer above the active one
+    LAYER_REMOVE = 15 # index
+    LAYER_MOVE = 16 # index, new index
+    LAYER_SELECT = 17 # index
+    LAYER_PROPS = 18 # index, visible, opacity, blend mode index
+    LAYER_PIXELS = 19 # same payload as LOAD, replaces the active layer's pixels
+    INDEXED = 20 # length + ARGB palette entries, empty back to ARGB32 pixels
+    RECOLOR = 21 # old ARGB, new ARGB
+    PATH = 22 # erase, length + int16 x, y of every point, one stroke through all of them
+    REGION_COPY = 23 # x, y, w, h of the active layer's cells, kept as the clipboard
+    REGION_LIFT = 24 # x, y, w, h taken off the active layer into the floating selection
+    REGION_PASTE = 25 # x, y, source: floating selection (0) or clipboard (1) written with its top left there
+    PIXELS = 26 # x, y, w, h, zlib length + compressed ARGB32 cells written to the active layer
+    FRAME_SELECT = 27 # index, the current frame is stored and that one loaded
+    FRAME_ADD = 28 # copy, new frame after the current one, a copy of it (1) or blank (0)
+    FRAME_REMOVE = 29 # the current frame
+    REGION_MASK = 30 # w, h, length + packed bits of the cells the next REGION_COPY or REGION_LIFT takes
+    FORMATS = {
+        NEW: struct.Struct("<HH"),
+        LOAD: struct.Struct("<HHI"),
+        TOOL: struct.Struct("<B"),
+        COLOR: struct.Struct("<I"),
+        PEN_SIZE: struct.Struct("<B"),
+        BEGIN: struct.Struct(""),
+        STROKE: struct.Struct("<hhhhB"),
+        FILL: struct.Struct("<hhBB"),
+        SHAPE: struct.Struct("<Bhhhh"),
+        COMMIT: struct.Struct(""),
+        UNDO: struct.Struct(""),
+        REDO: struct.Struct(""),
+        CLOSE: struct.Struct(""),
+        LAYER_ADD: struct.Struct(""),
+        LAYER_REMOVE: struct.Struct("<H"),
+        LAYER_MOVE: struct.Struct("<HH"),
+        LAYER_SELECT: struct.Struct("<H"),
+        LAYER_PROPS: struct.Struct("<HBBB"),
+        LAYER_PIXELS: struct.Struct("<HHI"),
+        INDEXED: struct.Struct("<I"),
+        RECOLOR: struct.Struct("<II"),
+        PATH: struct.Struct("<BI"),
+        REGION_COPY: struct.Struct("<hhHH"),
+        REGION_LIFT: struct.Struct("<hhHH"),
+        REGION_PASTE: struct.Struct("<hhB"),
+        PIXELS: struct.Struct("<hhHHI"),
+        FRAME_SELECT: struct.Struct("<H"),
+        FRAME_ADD: struct.Struct("<B"),
+        FRAME_REMOVE: struct.Struct(""),
+        REGION_MASK: struct.Struct("<HHI"),
+    }
+    PIXEL_RECORDS = (LOAD, LAYER_PIXELS) # followed by a compressed payload
+    PAYLOAD_RECORDS = PIXEL_RECORDS + (INDEXED, PATH, PIXELS, REGION_MASK) # last field is the payload length
+
+class JournalWriter(Journal): # records are packed on the caller's thread, pixels compressed and everything written in batches by a worker
+    FLUSH_INTERVAL = 0.25 # seconds
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb")
+        self.file.write(self.MAGIC)
+        self.buffer = []
+        self.lock = threading.Lock()
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="journal-writer", daemon=True)
+        self.thread.start()
+
+    def record(self, op, *args, payload=b""):
+        data = bytes([op]) + self.FORMATS[op].pack(*args) + payload
+        with self.lock:
+            self.buffer.append(data)
+
+    def recordCompressed(self, op, pixels, *args): # zlib runs on the writer thread, pixels must not change afterwards
+        with self.lock:
+            self.buffer.append((op, pixels, args))
+
+    def pack(self, item): # a record ready to write, compressing the pixels of one from recordCompressed
+        if isinstance(item, bytes):
+            return item
+        op, pixels, args = item
+        if isinstance(pixels, QImage):
+            pixels = imageArray(pixels, writable=False)
+        data = zlib.compress(np.ascontiguousarray(pixels).tobytes(), 1)
+        return bytes([op]) + self.FORMATS[op].pack(*args, len(data)) + data
+
+    def recordPixels(self, op, image): # the image shares its pixels, Qt copies them if the caller paints on it later
+        image = image.convertToFormat(QImage.Format_ARGB32)
+        self.recordCompressed(op, image, image.width(), image.height())
+
+    def recordRect(self, x, y, pixels): # ARGB32 array written with its top left at x, y
+        self.recordCompressed(self.PIXELS, pixels.astype(np.uint32), x, y, pixels.shape[1], pixels.shape[0])
+
+    def recordIndexed(self, palette):
+        data = b"" if palette is None else np.array(palette, np.uint32).tobytes()
+        self.record(self.INDEXED, len(data), payload=data)
+
+    def recordPath(self, points, erase):
+        data = np.array(points, np.int16).tobytes()
+        self.record(self.PATH, erase, len(data), payload=data)
+
+    def recordMask(self, mask):
+        data = np.packbits(mask).tobytes()
+        self.record(self.REGION_MASK, mask.shape[1], mask.shape[0], len(data), payload=data)
+
+    def recordLayerProps(self, index, layer):
+        self.record(self.LAYER_PROPS, index, layer.visible, layer.opacity, blend_names.index(layer.blend_mode))
+
+    def recordSnapshot(self, engine): # every layer of the canvas, enough to rebuild it from scratch
+        for index, layer in enumerate(engine.layers):
+            if index == 0:
+                self.recordPixels(self.LOAD, layer.toImage())
+            else:
+                self.record(self.LAYER_ADD)
+                self.recordPixels(self.LAYER_PIXELS, layer.toImage())
+            self.recordLayerProps(index, layer)
+        if engine.palette is not None:
+            self.recordIndexed(engine.palette)
+        self.record(self.LAYER_SELECT, engine.active)
+
+    def flush(self):
+        with self.lock:
+            batch, self.buffer = self.buffer, []
+        if batch:
+            with stats.timer("journal_write"):
+                self.file.write(b"".join(self.pack(item) for item in batch))
+                self.file.flush()
+
+    def run(self):
+        while not self.closing.wait(self.FLUSH_INTERVAL):
+            self.flush()
+
+    def close(self):
+        self.record(self.CLOSE)
+        self.closing.set()
+        self.thread.join()
+        self.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+class JournalReader(Journal):
+    def __init__(self, data):
+        self.data = data
+
+    @classmethod
+    def open(cls, path):
+        with open(path, "rb") as f:
+            return cls(f.read())
+
+    def records(self): # yields (op, args, payload); stops quietly at a record cut short by a crash
+        if not self.data.startswith(self.MAGIC):
+            raise ValueError("Not a journal file.")
+        offset = len(self.MAGIC)
+        while offset < len(self.data):
+            op = self.data[offset]
+            if op not in self.FORMATS:
+                raise ValueError(f"Unknown journal record {op} at byte {offset}.")
+            layout = self.FORMATS[op]
+            end = offset + 1 + layout.size
+            if end > len(self.data):
+                return
+            args = layout.unpack_from(self.data, offset + 1)
+            payload = b""
+            if op in self.PAYLOAD_RECORDS:
+                payload = self.data[end:end + args[-1]]
+                if len(payload) < args[-1]:
+                    return
+                end += args[-1]
+            yield op, args, payload
+            offset = end
+
+    def needsRecovery(self): # written to but not closed cleanly
+        last = None
+        for last, _, _ in self.records():
+            pass
+        return last is not None and last != self.CLOSE
+
+class JournalReplayer(Journal): # applies records to a headless PixelCanvas, no widgets or timing involved
+    def __init__(self, engine=None, timeline=None):
+        self.engine = engine or PixelCanvas()
+        self.timeline = timeline or Timeline(self.engine) # animation frames, the engine holds the current one
+        self.tool = 1
+        self.color = 0xFF000000
+        self.pen_size = 1
+        self.floating = None # Region lifted by the last REGION_LIFT
+        self.mask = None # cells the next REGION_COPY or REGION_LIFT takes, from REGION_MASK
+        self.records = 0
+
+    def apply(self, op, args, payload):
+        engine = self.engine
+        self.records += 1
+        if op == self.NEW:
+            engine.clear(*args)
+            self.timeline.reset()
+        elif op in self.PIXEL_RECORDS:
+            width, height, _ = args
+            image = QImage(zlib.decompress(payload), width, height, width * 4, QImage.Format_ARGB32).copy() # detach from the bytes
+            if op == self.LOAD:
+                engine.load(image)
+                self.timeline.reset()
+            else:
+                engine.activeLayer().setImage(image)
+                engine.invalidateComposite()
+        elif op == self.TOOL:
+            self.tool = args[0]
+        elif op == self.COLOR:
+            self.color = args[0]
+        elif op == self.PEN_SIZE:
+            self.pen_size = args[0]
+        elif op == self.BEGIN:
+            engine.saveState()
+        elif op == self.STROKE:
+            x1, y1, x2, y2, erase = args
+            engine.stroke(x1, y1, x2, y2, self.color, self.pen_size, bool(erase))
+        elif op == self.PATH:
+            points = [tuple(point) for point in np.frombuffer(payload, np.int16).reshape(-1, 2).tolist()]
+            engine.strokePath(points, self.color, self.pen_size, bool(args[0]))
+        elif op == self.FILL:
+            x, y, tolerance, contiguous = args
+            engine.fill(x, y, self.color, tolerance, bool(contiguous))
+        elif op == self.SHAPE:
+            shape, x1, y1, x2, y2 = args
+            engine.drawShape(shape_names[shape], x1, y1, x2, y2, self.color)
+        elif op == self.COMMIT:
+            engine.commitState()
+        elif op == self.UNDO:
+            engine.undo()
+        elif op == self.REDO:
+            engine.redo()
+        elif op == self.LAYER_ADD:
+            engine.addLayer()
+        elif op == self.LAYER_REMOVE:
+            engine.removeLayer(args[0])
+        elif op == self.LAYER_MOVE:
+            engine.moveLayer(*args)
+        elif op == self.LAYER_SELECT:
+            engine.setActiveLayer(args[0])
+        elif op == self.LAYER_PROPS:
+            index, visible, opacity, blend = args
+            engine.setLayerVisible(index, bool(visible))
+            engine.setLayerOpacity(index, opacity)
+            engine.setLayerBlend(index, blend_names[blend])
+        elif op == self.INDEXED:
+            engine.setIndexed([int(color) for color in np.frombuffer(payload, np.uint32)] if payload else None)
+        elif op == self.RECOLOR:
+            engine.remap({args[0]: args[1]})
+        elif op == self.REGION_MASK:
+            w, h, _ = args
+            self.mask = np.unpackbits(np.frombuffer(payload, np.uint8), count=w * h).reshape(h, w).astype(bool)
+        elif op == self.REGION_COPY:
+            engine.copyRegion(QRect(*args), self.mask)
+            self.mask = None
+        elif op == self.REGION_LIFT:
+            self.floating = engine.liftRegion(QRect(*args), self.mask)
+            self.mask = None
+        elif op == self.REGION_PASTE:
+            x, y, clipboard = args
+            engine.pasteRegion(engine.clipboard if clipboard else self.floating, x, y)
+        elif op == self.PIXELS:
+            x, y, w, h, _ = args
+            engine.writePixels(x, y, np.frombuffer(zlib.decompress(payload), np.uint32).reshape(h, w))
+        elif op == self.FRAME_SELECT:
+            self.timeline.select(args[0])
+        elif op == self.FRAME_ADD:
+            self.timeline.addFrame(bool(args[0]))
+        elif op == self.FRAME_REMOVE:
+            self.timeline.removeFrame()
+
+    def replay(self, reader):
+        for op, args, payload in reader.records():
+            self.apply(op, args, payload)
+        self.engine.commitState() # a crash can leave the last operation open
+        self.engine.takeDirty()
+        return self
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a canvas journal headlessly.")
+    parser.add_argument("journal")
+    parser.add_argument("-o", "--output", help="save the rebuilt canvas to this image")
+    args = parser.parse_args(argv)
+
+    reader = JournalReader.open(args.journal)
+    start = time.perf_counter()
+    replayer = JournalReplayer().replay(reader)
+    elapsed = time.perf_counter() - start
+    print(f"{replayer.records} records replayed in {elapsed * 1000:.1f} ms ({replayer.records / max(elapsed, 1e-9):.0f} records/s)")
+    if args.output and not replayer.engine.flatten().save(args.output):
+        print(f"Could not write {args.output}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
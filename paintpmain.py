@@ -1,15 +1,27 @@
 import sys
+import os
+import math
+import numpy as np
 import PyQt5 # unused
 from PyQt5 import QtCore, QtGui, QtWidgets # unused
 from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 from functools import partial
+from collections import OrderedDict
+from paintengine import PixelCanvas, Layer, imageArray, shapeMask, shapeRect, maskImage, blend_modes
+from paintjournal import Journal, JournalWriter, JournalReader, JournalReplayer, shape_names, blend_names
+from paintproject import ProjectWriter, loadProject
+from paintio import Cancelled, openJob, importJob, indexedJob, saveJob, exportJob, export_scales, export_formats
+from paintanim import Timeline, stripJob, gifJob, writeGif
+from paintfilters import filters, filterJob, filterResult, scalePixelArt
+from paintstats import stats
 
 """This is a pixel art paint app."""
 
 default_grid_size = int(64)
 default_cell_size = int(10)
+max_grid_size = int(4096)
  
 class Canvas(QLabel):
     isDrawing = True
@@ -18,322 +30,547 @@ class Canvas(QLabel):
     isLine = False
     isRectangle = False
     isEllipse = False
+    isSelecting = False
+    isPicking = False
     MIN_ZOOM = 0.125
-    MAX_ZOOM = 8.0
+    MAX_ZOOM = 64.0
+    RENDER_TILE = 256 # widget pixels per side of a cached render tile
+    RENDER_CACHE = 256 # render tiles kept, 256 KB each
+    ONION_OPACITY = 0.3 # neighbouring frames under the current one
+    GRID_MIN_SCALE = 4 # widget pixels per cell below which the grid overlay is not drawn
+    GRID_COLOR = QColor(0, 0, 0, 60)
+    SELECTION_COLOR = 0x503399FF # tint over the cells of a selection that is not a plain rectangle
+    FRAME_INTERVAL = 8 # ms, queued mouse input is applied at most once per frame (about 120 Hz)
     zoomChanged = pyqtSignal(float)
+    pixelsChanged = pyqtSignal(QRect) # cells the engine wrote, emitted once per repaint
+    colorPicked = pyqtSignal(QColor) # under the eyedropper
+    toolChanged = pyqtSignal(int) # drawing mode, also when the canvas switches tool itself, e.g. to select for a paste
     pen_size = 1
     current_opac = 255
+    fill_tolerance = 0
+    fill_contiguous = True
+    fill_shapes = False # rectangle and ellipse tools draw filled shapes
+    onion_skin = False # previous and next frames shown faintly under the current one
+    show_grid = False # cell grid drawn over the render tiles
+    drawing_mode = 1
+    journal = None # JournalWriter recording every input operation, if set
 
     def __init__(self, grid_size=default_grid_size, cell_size=default_cell_size):
         super().__init__()
-        self.grid_size = grid_size
+        self.engine = PixelCanvas(grid_size) # pixel buffer, drawing and history live here
+        if os.environ.get("ITPAINT_HISTORY_MB"): # undo and redo budget in MiB instead of PixelCanvas.HISTORY_BUDGET
+            self.engine.setHistoryBudget(int(os.environ["ITPAINT_HISTORY_MB"]) * 1024 * 1024)
         self.cell_size = cell_size
         self.zoom_level = 1
-        self.undo_stack = []
-        self.redo_stack = []
         self.setMouseTracking(True)
         self.hover_cell = None
+        self.last_pos = None # end of the stroke drawn so far
+        self.queued_cells = [] # stroke cells from mouse moves, drawn on the next frame
+        self.queued_hover = None
+        self.queued_shape = False # shape corner moved since the last preview
+        self.frame_timer = QTimer(self)
+        self.frame_timer.setSingleShot(True)
+        self.frame_timer.setInterval(self.FRAME_INTERVAL)
+        self.frame_timer.timeout.connect(self.flushInput)
+        self.preview = None # in-progress shape as (cell rect, image), drawn over the canvas until release
+        self.selection = None # QRect of selected cells
+        self.selection_mask = None # bool array over the selection, None when every cell of it is selected
+        self.selection_overlay = None # tint image of selection_mask
+        self.selecting = False # marquee being dragged out from start_pos
+        self.floating = None # (Region, from clipboard) shown as the preview until dropped
+        self.grab_offset = None # cell grabbed inside the floating selection while it is dragged
+        self.queued_drag = None # cell under the pointer while selecting or moving
+        self.dirty_rect = QRect() # cells touched since the last repaint request
+        self.render_cache = OrderedDict() # (cell scale, column, row) -> QPixmap, least recently used first
+        self.grid_paths = {} # (cell scale, x offset, y offset, width, height) -> grid lines of one render tile
+        self.timeline = Timeline(self.engine) # animation frames, the engine holds the current one
+        self.onion_images = [] # flattened neighbouring frames while onion_skin is on
         self.initCanvas()
        
     def initCanvas(self):
-        self.width, self.height = self.grid_size * self.cell_size, self.grid_size * self.cell_size
+        self.width, self.height = self.engine.width * self.cell_size, self.engine.height * self.cell_size
         self.setFixedSize(self.width, self.height)
-        self.image = QPixmap(self.width, self.height)
-        self.image.fill(Qt.transparent)
-        self.setPixmap(self.image)
         self.pen_color = QColor("#000000")
         self.setCustomCursor("icons/cursor.png")
         self.createCaroPattern()
         self.updateTransform()
 
     def updateTransform(self): # note: no scaling of QPixmap happens here directly because painter/paintEvent handles scaling
-        width = int(self.grid_size * self.cell_size * self.zoom_level)
-        height = int(self.grid_size * self.cell_size * self.zoom_level)
+        width = int(self.engine.width * self.cell_size * self.zoom_level)
+        height = int(self.engine.height * self.cell_size * self.zoom_level)
         self.setFixedSize(width, height)
 
+        self.dirty_rect = QRect() # covered by the full repaint
+        changed = self.engine.takeDirty()
+        self.invalidateRender(changed)
+        if not changed.isEmpty():
+            self.pixelsChanged.emit(changed)
         self.update()  # trigger repaint with new scaling
-    
-    def createCaroPattern(self):
-        painter = QPainter(self)
-        painter.scale(self.zoom_level, self.zoom_level)
-
-        color1 = QColor("#E0E0E0")
-        color2 = QColor("#FFFFFF")
-
-        for y in range(0, self.height, self.cell_size):
-            for x in range(0, self.width, self.cell_size):
-                color = color1 if (x // self.cell_size + y // self.cell_size) % 2 == 0 else color2
-                painter.fillRect(x, y, self.cell_size, self.cell_size, color)
 
-        painter.drawPixmap(0, 0, self.image)
+    def markDirty(self, x, y, w=1, h=1): # accumulate touched cells until flushDirty
+        self.dirty_rect = self.dirty_rect.united(QRect(x, y, w, h))
+
+    def flushDirty(self): # repaint only the accumulated cells and those the engine wrote
+        changed = self.engine.takeDirty()
+        self.invalidateRender(changed)
+        if not changed.isEmpty():
+            self.pixelsChanged.emit(changed)
+        self.dirty_rect = self.dirty_rect.united(changed)
+        if not self.dirty_rect.isEmpty():
+            self.update(self.cellsToWidget(self.dirty_rect))
+        self.dirty_rect = QRect()
+
+    def cellsToWidget(self, rect): # cell rect -> widget rect at the current zoom
+        scale = self.cell_size * self.zoom_level
+        left = int(rect.left() * scale)
+        top = int(rect.top() * scale)
+        right = math.ceil((rect.right() + 1) * scale)
+        bottom = math.ceil((rect.bottom() + 1) * scale)
+        margin = 2 # the outline pens are cosmetic and reach at most a pixel past the cell edges
+        return QRect(left, top, right - left, bottom - top).adjusted(-margin, -margin, margin, margin)
+
+    def widgetToCells(self, rect): # widget rect -> cell rect covering it, clipped to the grid
+        scale = self.cell_size * self.zoom_level
+        left = max(0, int(rect.left() / scale))
+        top = max(0, int(rect.top() / scale))
+        right = min(self.engine.width, math.ceil((rect.right() + 1) / scale))
+        bottom = min(self.engine.height, math.ceil((rect.bottom() + 1) / scale))
+        return QRect(left, top, right - left, bottom - top)
+
+    def memoryBytes(self): # canvas pixels, cached stacks, cached render tiles and stored frames
+        rendered = sum(pixmap.width() * pixmap.height() * pixmap.depth() // 8 for pixmap in self.render_cache.values())
+        return self.engine.pixelBytes() + rendered + self.timeline.storedBytes()
+
+    def renderTile(self, column, row): # one RENDER_TILE square of the widget, checkerboard and composite, cached per zoom
+        scale = self.cell_size * self.zoom_level
+        key = (scale, column, row)
+        pixmap = self.render_cache.get(key)
+        if pixmap is not None:
+            self.render_cache.move_to_end(key)
+            return pixmap
+
+        size = self.RENDER_TILE
+        area = QRect(column * size, row * size, size, size)
+        pixmap = QPixmap(size, size)
+        painter = QPainter(pixmap)
+        painter.setBrushOrigin(-area.x(), -area.y()) # keep the checkerboard aligned across render tiles
+        painter.fillRect(pixmap.rect(), self.createCaroPattern())
+        painter.translate(-area.x(), -area.y())
+        painter.scale(self.zoom_level, self.zoom_level)
+        cells = self.widgetToCells(area)
+        target = QRect(cells.x() * self.cell_size, cells.y() * self.cell_size,
+                       cells.width() * self.cell_size, cells.height() * self.cell_size)
+        painter.setOpacity(self.ONION_OPACITY)
+        for image in self.onion_images:
+            painter.drawImage(target, image, cells)
+        painter.setOpacity(1)
+        layer = self.engine.activeLayer()
+        for tx, ty in layer.tileKeys(*cells.getRect()):
+            image = self.engine.compositeTile(tx, ty)
+            if image is not None: # only the cells in view, so the nearest-neighbour scaling starts on a cell edge
+                source = layer.tileRect(tx, ty).intersected(cells)
+                target = QRect(source.x() * self.cell_size, source.y() * self.cell_size,
+                               source.width() * self.cell_size, source.height() * self.cell_size)
+                painter.drawImage(target, image, source.translated(-tx * Layer.TILE, -ty * Layer.TILE))
+        if self.show_grid and scale >= self.GRID_MIN_SCALE:
+            painter.resetTransform()
+            painter.setPen(QPen(self.GRID_COLOR, 0))
+            painter.drawPath(self.gridPath(scale, area))
         painter.end()
 
+        self.render_cache[key] = pixmap
+        while len(self.render_cache) > self.RENDER_CACHE:
+            self.render_cache.popitem(last=False)
+        return pixmap
+
+    def gridPath(self, scale, area): # cell edges inside a render tile as one path, in tile coordinates
+        right = min(area.right() + 1, self.engine.width * scale) - area.x()
+        bottom = min(area.bottom() + 1, self.engine.height * scale) - area.y()
+        key = (scale, -area.x() % scale, -area.y() % scale, right, bottom) # tiles at the same offset from a cell edge share it
+        path = self.grid_paths.get(key)
+        if path is None:
+            if len(self.grid_paths) > 64: # only a handful are in use at one zoom
+                self.grid_paths.clear()
+            _, left, top, right, bottom = key
+            path = QPainterPath()
+            x = left
+            while x < right:
+                path.moveTo(x, 0)
+                path.lineTo(x, bottom)
+                x += scale
+            y = top
+            while y < bottom:
+                path.moveTo(0, y)
+                path.lineTo(right, y)
+                y += scale
+            self.grid_paths[key] = path
+        return path
+
+    def setGrid(self, shown):
+        self.show_grid = shown
+        self.render_cache.clear()
+        self.update()
+
+    def invalidateRender(self, rect): # drop cached render tiles showing any of these cells, at every zoom
+        if rect.isEmpty():
+            return
+        size = self.RENDER_TILE
+        for key in list(self.render_cache):
+            scale, column, row = key
+            cells = QRectF(rect.x() * scale, rect.y() * scale, rect.width() * scale, rect.height() * scale)
+            if cells.adjusted(-1, -1, 1, 1).intersects(QRectF(column * size, row * size, size, size)):
+                del self.render_cache[key]
+    
+    def createCaroPattern(self): # tiled brush, rebuilt only when cell size or zoom change
+        key = (self.cell_size, self.zoom_level)
+        if getattr(self, "caro_key", None) == key:
+            return self.caro_brush
+        with stats.timer("caro"):
+            color1 = QColor("#E0E0E0")
+            color2 = QColor("#FFFFFF")
+
+            size = max(1, round(self.cell_size * self.zoom_level)) # one cell in widget pixels
+            tile = QPixmap(size * 2, size * 2)
+            tile.fill(color2)
+            painter = QPainter(tile)
+            painter.fillRect(0, 0, size, size, color1)
+            painter.fillRect(size, size, size, size, color1)
+            painter.end()
+
+            self.caro_brush = QBrush(tile)
+            self.caro_key = key
+            return self.caro_brush
+
+    def setJournal(self, journal): # start recording from a snapshot of the current state
+        self.journal = journal
+        journal.recordSnapshot(self.engine)
+        journal.record(Journal.TOOL, self.drawing_mode)
+        journal.record(Journal.COLOR, self.pen_color.rgba())
+        journal.record(Journal.PEN_SIZE, self.pen_size)
+
+    def journalRecord(self, op, *args):
+        if self.journal:
+            self.journal.record(op, *args)
+
+    def replayJournal(self, reader): # crash recovery: rebuild the canvas, its frames and its history from a journal
+        replayer = JournalReplayer(self.engine, self.timeline).replay(reader)
+        self.floating = None
+        self.preview = None
+        self.setSelection(None)
+        self.width, self.height = self.engine.width * self.cell_size, self.engine.height * self.cell_size
+        self.createCaroPattern()
+        self.updateTransform()
+        self.setDrawingMode(replayer.tool)
+        self.pen_color = QColor.fromRgba(replayer.color)
+        self.current_opac = self.pen_color.alpha()
+        self.pen_size = replayer.pen_size
+        return replayer
+
     def setPenColor(self, color):
         self.pen_color = QColor(color)
         self.current_color = color
         self.changeOpac(self.current_opac)
 
-    def clearCanvas(self, grid_size, cell_size):
-        self.grid_size = grid_size
+    def clearCanvas(self, width, cell_size, height=None):
+        self.engine.clear(width, height)
+        self.journalRecord(Journal.NEW, self.engine.width, self.engine.height)
+        self.resetFrames()
         self.cell_size = cell_size
-        self.width = grid_size * cell_size
-        self.height = self.width
-        self.image = QPixmap(grid_size * cell_size, grid_size * cell_size)
-
-        self.image.fill(Qt.transparent)
-        self.setPixmap(self.image)
+        self.width, self.height = self.engine.width * cell_size, self.engine.height * cell_size
         self.createCaroPattern()
         self.updateTransform()
 
+    def openProject(self, path): # returns the saved palette and tool state, and a writer that keeps saving to path
+        state, writer = loadProject(path, self.engine)
+        if self.journal:
+            self.journal.recordSnapshot(self.engine)
+        self.resetFrames()
+        self.width, self.height = self.engine.width * self.cell_size, self.engine.height * self.cell_size
+        self.updateTransform()
+        return state, writer
+
+    def toolState(self): # saved with a project
+        return {
+            "mode": self.drawing_mode,
+            "color": self.pen_color.rgba(),
+            "pen_size": self.pen_size,
+            "fill_tolerance": self.fill_tolerance,
+            "fill_contiguous": self.fill_contiguous,
+            "fill_shapes": self.fill_shapes,
+        }
+
+    def loadImage(self, image): # QImage of any size, one pixel per cell
+        self.clearCanvas(image.width(), self.cell_size, image.height())
+        self.engine.load(image)
+        if self.journal:
+            self.journal.recordSnapshot(self.engine)
+        self.resetFrames()
+        self.updateTransform()
+
     def mousePressEvent(self, e):
+        stats.count("input")
         if e.buttons() & Qt.LeftButton:
-            self.saveState()
+            self.flushInput()
             self.start_pos = self.snapToGrid(e.pos())
-            if self.isDrawing:
-                self.drawEvent(e)
-            elif self.isErasing:
-                self.eraseEvent(e)
+            if not (self.isSelecting and self.floating and self.preview[0].contains(self.start_pos)):
+                self.dropFloating()
+            self.saveState()
+            if self.isDrawing or self.isErasing: # the first cell is drawn with the first batch, on the next frame
+                self.last_pos = None
+                self.queued_cells = [(self.start_pos.x(), self.start_pos.y())]
+                self.frame_timer.start()
             elif self.isFilling:
-                x = int((e.x() / self.zoom_level) // self.cell_size) * self.cell_size
-                y = int((e.y() / self.zoom_level) // self.cell_size) * self.cell_size
-                self.fillEvent(x, y)
+                self.fillEvent(self.start_pos.x(), self.start_pos.y())
             elif self.isLine or self.isRectangle or self.isEllipse:
-                self.temp_image = self.image.copy()
-
-    def mouseMoveEvent(self, e):
+                self.shape_rect = QRect()
+            elif self.isSelecting:
+                self.pressSelection(self.start_pos)
+            elif self.isPicking:
+                self.pickColor(self.start_pos.x(), self.start_pos.y())
+
+    def mouseMoveEvent(self, e): # only queues, flushInput applies everything once per frame
+        stats.count("input")
         cell_size_zoomed = self.cell_size * self.zoom_level
-        x = int(e.x() / cell_size_zoomed)
-        y = int(e.y() / cell_size_zoomed)
-        new_hover_cell = (x, y)
-        if new_hover_cell != self.hover_cell:
-            self.hover_cell = new_hover_cell
-            self.update()
+        self.queued_hover = (int(e.x() / cell_size_zoomed), int(e.y() / cell_size_zoomed))
 
         if e.buttons() & Qt.LeftButton:
-            if self.isDrawing:
-                self.drawEvent(e)
-            elif self.isErasing:
-                self.eraseEvent(e)
+            if self.isDrawing or self.isErasing:
+                self.queueStroke(e)
             elif self.isLine or self.isRectangle or self.isEllipse:
                 self.end_pos = self.snapToGrid(e.pos())
-                self.image = self.temp_image.copy()
-                self.drawShapePreview()
-                self.updateTransform()
+                self.queued_shape = True
+            elif self.isSelecting:
+                self.queued_drag = self.snapToGrid(e.pos())
+        if not self.frame_timer.isActive():
+            self.frame_timer.start()
+
+    def queueStroke(self, e): # every cell the mouse reported is kept, consecutive ones are joined by lines
+        pos = self.snapToGrid(e.pos())
+        cell = (pos.x(), pos.y())
+        if cell != (self.queued_cells[-1] if self.queued_cells else self.last_pos):
+            self.queued_cells.append(cell)
+
+    def flushInput(self): # the input queued since the last frame, drawn as one batch with one repaint
+        self.frame_timer.stop()
+        if self.queued_cells: # joined to the previous batch, the engine blends the shared cells only once per stroke
+            self.drawOrErasePath(([self.last_pos] if self.last_pos else []) + self.queued_cells, self.isErasing)
+            self.last_pos = self.queued_cells[-1]
+            self.queued_cells = []
+        if self.queued_shape:
+            self.drawShapePreview()
+            self.queued_shape = False
+        if self.queued_drag:
+            self.dragSelection(self.queued_drag)
+            self.queued_drag = None
+        if self.queued_hover and self.queued_hover != self.hover_cell:
+            if self.hover_cell:
+                self.markDirty(*self.hover_cell)
+            self.hover_cell = self.queued_hover
+            self.markDirty(*self.hover_cell)
+        self.queued_hover = None
+        self.flushDirty()
 
     def mouseReleaseEvent(self, e):
+        stats.count("input")
         if e.button() == Qt.LeftButton:
+            self.flushInput() # the stroke is complete before it is committed
             if self.isLine or self.isRectangle or self.isEllipse:
                 self.end_pos = self.snapToGrid(e.pos())
                 self.drawShapeFinal()
-                self.updateTransform()
+                self.flushDirty()
+            elif self.isSelecting:
+                self.releaseSelection()
+            self.commitState()
             self.last_pos = None
 
     def paintEvent(self, e):
-        super().paintEvent(e)
-        self.createCaroPattern()
-        painter = QPainter(self)
-
-        painter.fillRect(self.rect(), Qt.transparent) # proper reset when updating
-        painter.scale(self.zoom_level, self.zoom_level)
-        painter.drawPixmap(0, 0, self.pixmap())
-
-        if self.hover_cell: # hover
-            cell_size_zoomed = self.cell_size
-            x, y = self.hover_cell
-            painter.setBrush(QColor(50, 25, 25, 100))
-            painter.setPen(QColor(50, 25, 25))
-            painter.drawRect(x * cell_size_zoomed, y * cell_size_zoomed, cell_size_zoomed, cell_size_zoomed)
-
-        painter.end()
-
-    def drawOrEraseLine(self, start_pos, end_pos, painter, erase=False):
-        x1, y1 = start_pos.x(), start_pos.y()
-        x2, y2 = end_pos.x(), end_pos.y()
-        dx = abs(x2 - x1)
-        dy = abs(y2 - y1)
-        sx = self.cell_size if x1 < x2 else -self.cell_size
-        sy = self.cell_size if y1 < y2 else -self.cell_size
-        err = dx - dy
-
-        while True:
-            size = self.cell_size * self.pen_size
-            if erase:
-                painter.setCompositionMode(QPainter.CompositionMode_Clear)
-                painter.fillRect(x1, y1, size, size, Qt.transparent)
-            else:
-                painter.fillRect(x1, y1, size, size, self.pen_color)
-
-            if x1 == x2 and y1 == y2:
-                break
-            e2 = err * 2
-            if e2 > -dy:
-                err -= dy
-                x1 += sx
-            if e2 < dx:
-                err += dx
-                y1 += sy
-
-    def drawEvent(self, e):
-        current_x = int(e.x() / self.zoom_level // self.cell_size) * self.cell_size
-        current_y = int(e.y() / self.zoom_level // self.cell_size) * self.cell_size
-        current_pos = QPoint(current_x, current_y)
-
-        if not hasattr(self, "last_pos") or self.last_pos is None:
-            self.last_pos = current_pos
-
-        painter = QPainter(self.image)
-        self.drawOrEraseLine(self.last_pos, current_pos, painter, erase=False)
-        painter.end()
-
-        self.last_pos = current_pos
-        self.updateTransform()
-
-    def eraseEvent(self, e):
-        current_x = int((e.x() / self.zoom_level) // self.cell_size) * self.cell_size
-        current_y = int((e.y() / self.zoom_level) // self.cell_size) * self.cell_size
-        current_pos = QPoint(current_x, current_y)
-
-        if not hasattr(self, "last_pos") or self.last_pos is None:
-            self.last_pos = current_pos
-
-        painter = QPainter(self.image)
-        self.drawOrEraseLine(self.last_pos, current_pos, painter, erase=True)
-        painter.end()
-
-        self.last_pos = current_pos
-        self.updateTransform()
+        with stats.timer("paint"):
+            super().paintEvent(e)
+            painter = QPainter(self)
+            painter.setClipRect(e.rect()) # only the exposed area is redrawn, the scroll area exposes just the viewport
+
+            size = self.RENDER_TILE
+            exposed = e.rect().intersected(self.rect())
+            for row in range(exposed.top() // size, exposed.bottom() // size + 1):
+                for column in range(exposed.left() // size, exposed.right() // size + 1):
+                    painter.drawPixmap(column * size, row * size, self.renderTile(column, row))
+            painter.scale(self.zoom_level, self.zoom_level)
+
+            if self.preview: # shape overlay, one scaled image
+                rect, image = self.preview
+                painter.drawImage(QRect(rect.topLeft() * self.cell_size, rect.size() * self.cell_size), image)
+
+            if self.selection_overlay: # cells of a masked selection
+                painter.drawImage(QRect(self.selection.topLeft() * self.cell_size, self.selection.size() * self.cell_size), self.selection_overlay)
+
+            if self.selection: # marquee, on the cell edges
+                painter.setBrush(Qt.NoBrush)
+                painter.setPen(QPen(Qt.black, 0, Qt.DashLine))
+                painter.drawRect(QRect(self.selection.topLeft() * self.cell_size, self.selection.size() * self.cell_size))
+
+            if self.hover_cell: # hover
+                cell_size_zoomed = self.cell_size
+                x, y = self.hover_cell
+                painter.setBrush(QColor(50, 25, 25, 100))
+                painter.setPen(QPen(QColor(50, 25, 25), 0)) # cosmetic, one screen pixel at any zoom
+                painter.drawRect(x * cell_size_zoomed, y * cell_size_zoomed, cell_size_zoomed, cell_size_zoomed)
+
+            painter.end()
+
+    def drawOrErasePath(self, points, erase=False): # one stroke through a list of (x, y) cells
+        with stats.timer("stroke"):
+            if self.journal:
+                self.journal.recordPath(points, erase)
+            self.engine.strokePath(points, self.pen_color.rgba(), self.pen_size, erase)
 
     def fillEvent(self, x, y):
-        img = self.image.toImage()
-        target_color = img.pixelColor(x, y)
-        if target_color == self.pen_color:
-            return 
-        stack = [(x, y)]
-        visited = set()
-        while stack:
-            cx, cy = stack.pop()
-            if (cx, cy) in visited:
-                continue
-            if not (0 <= cx < self.image.width() and 0 <= cy < self.image.height()):
-                continue 
-            current_color = img.pixelColor(cx, cy)
-            if current_color == target_color:
-                painter = QPainter(self.image)
-                painter.fillRect(cx, cy, self.cell_size, self.cell_size, self.pen_color)
-                painter.end()
-                visited.add((cx, cy))
-                stack.extend([(cx + self.cell_size, cy), (cx - self.cell_size, cy), 
-                            (cx, cy + self.cell_size), (cx, cy - self.cell_size)])
-        self.updateTransform()
-
-    def snapToGrid(self, pos):
-        x = int((pos.x() / self.zoom_level) // self.cell_size) * self.cell_size
-        y = int((pos.y() / self.zoom_level) // self.cell_size) * self.cell_size
+        with stats.timer("fill"):
+            self.journalRecord(Journal.FILL, x, y, self.fill_tolerance, self.fill_contiguous)
+            self.engine.fill(x, y, self.pen_color.rgba(), self.fill_tolerance, self.fill_contiguous)
+            self.flushDirty()
+
+    def snapToGrid(self, pos): # widget position -> logical pixel (cell) position
+        x = int((pos.x() / self.zoom_level) // self.cell_size)
+        y = int((pos.y() / self.zoom_level) // self.cell_size)
         return QPoint(x, y)
     
-    def drawShapePreview(self):
-        painter = QPainter(self.image)
-        painter.setPen(QPen(self.pen_color, 1))
+    def currentShape(self):
         if self.isLine:
-            self.drawLine(painter, self.start_pos, self.end_pos)
-        elif self.isRectangle:
-            self.drawRectangle(painter, self.start_pos, self.end_pos)
-        elif self.isEllipse:
-            self.drawEllipse(painter, self.start_pos, self.end_pos)
-        painter.end()
+            return "line"
+        shape = "rectangle" if self.isRectangle else "ellipse"
+        return "filled " + shape if self.fill_shapes else shape
+
+    def setSelection(self, rect, mask=None): # None or an empty rect clears it
+        if self.selection:
+            self.markDirty(*self.selection.getRect())
+        self.selection = rect if rect and not rect.isEmpty() else None
+        self.selection_mask = mask if self.selection else None
+        self.selection_overlay = None if self.selection_mask is None else maskImage(self.selection_mask, self.SELECTION_COLOR)
+        if self.selection:
+            self.markDirty(*self.selection.getRect())
+
+    def pressSelection(self, cell): # grab the floating selection, lift the selected cells, or start a new marquee
+        if self.floating and self.preview[0].contains(cell):
+            self.grab_offset = cell - self.preview[0].topLeft()
+        elif self.selection and self.selection.contains(cell):
+            rect = self.selection
+            self.journalMask()
+            self.journalRecord(Journal.REGION_LIFT, *rect.getRect())
+            region = self.engine.liftRegion(rect, self.selection_mask)
+            self.floating = region, False
+            self.preview = rect, region.toImage() # converted once, moves only change where it is drawn
+            self.grab_offset = cell - rect.topLeft()
+        else:
+            self.selecting = True
+            self.setSelection(None)
+        self.flushDirty()
+
+    def dragSelection(self, cell):
+        if self.grab_offset is not None: # the overlay moves, the canvas is untouched until the drop
+            rect, image = self.preview
+            self.markDirty(*rect.getRect())
+            self.preview = QRect(cell - self.grab_offset, rect.size()), image
+            self.setSelection(self.preview[0], self.selection_mask)
+        elif self.selecting:
+            self.setSelection(QRect(self.start_pos, cell).normalized().intersected(QRect(0, 0, self.engine.width, self.engine.height)))
+
+    def releaseSelection(self):
+        if self.grab_offset is not None:
+            self.grab_offset = None
+            self.dropFloating(commit=False) # part of the history entry opened by the press
+        elif self.selecting:
+            self.selecting = False
+            if self.selection and self.selection.size() == QSize(1, 1): # a click clears the selection
+                self.setSelection(None)
+        self.flushDirty()
+
+    def dropFloating(self, commit=True): # write the floating selection where it is shown
+        if not self.floating:
+            return
+        (region, clipboard), (rect, _) = self.floating, self.preview
+        self.floating = None
+        self.preview = None
+        self.markDirty(*rect.getRect())
+        if commit:
+            self.saveState()
+        self.journalRecord(Journal.REGION_PASTE, rect.x(), rect.y(), clipboard)
+        self.engine.pasteRegion(region, rect.x(), rect.y())
+        if commit:
+            self.commitState()
+        self.flushDirty()
+
+    def copySelection(self):
+        self.dropFloating()
+        if self.selection:
+            self.journalMask()
+            self.journalRecord(Journal.REGION_COPY, *self.selection.getRect())
+            self.engine.copyRegion(self.selection, self.selection_mask)
+
+    def cutSelection(self):
+        self.copySelection()
+        self.deleteSelection()
+
+    def deleteSelection(self): # selected cells become transparent
+        self.dropFloating()
+        if self.selection:
+            self.saveState()
+            self.journalMask()
+            self.journalRecord(Journal.REGION_LIFT, *self.selection.getRect())
+            self.engine.liftRegion(self.selection, self.selection_mask)
+            self.commitState()
+            self.flushDirty()
+
+    def paste(self): # the clipboard floats over its original place until it is moved or dropped
+        self.dropFloating()
+        region = self.engine.clipboard
+        if region is None or region.rect.isEmpty():
+            return
+        if not self.isSelecting:
+            self.changeToSelect()
+        self.floating = region, True
+        self.preview = QRect(region.rect), region.toImage()
+        self.setSelection(self.preview[0], region.mask)
+        self.flushDirty()
+
+    def selectColorCells(self, color): # every cell of a colour on the active layer, masked inside the rectangle spanning them
+        if not self.isSelecting:
+            self.changeToSelect()
+        self.deselect()
+        bounds = self.engine.colorBounds(color)
+        self.setSelection(bounds, None if bounds.isEmpty() else self.engine.colorMask(color, bounds))
+        self.flushDirty()
+
+    def journalMask(self): # the cells of a masked selection, for the REGION_COPY or REGION_LIFT recorded next
+        if self.journal and self.selection_mask is not None:
+            self.journal.recordMask(self.selection_mask)
+
+    def pickColor(self, x, y):
+        color = self.engine.colorAt(x, y)
+        if color >> 24: # nothing to pick from transparent cells
+            self.colorPicked.emit(QColor.fromRgba(color))
+
+    def deselect(self):
+        self.dropFloating()
+        self.setSelection(None)
+        self.flushDirty()
+
+    def drawShapePreview(self): # overlay only, the image is untouched until drawShapeFinal
+        corners = (self.start_pos.x(), self.start_pos.y(), self.end_pos.x(), self.end_pos.y())
+        rect = shapeRect(*corners)
+        self.markDirty(*self.shape_rect.getRect()) # clear the previous preview
+        self.markDirty(*rect.getRect())
+        self.shape_rect = rect
+        left, top, mask = shapeMask(self.currentShape(), *corners)
+        self.preview = QRect(left, top, mask.shape[1], mask.shape[0]), maskImage(mask, self.pen_color.rgba())
         
     def drawShapeFinal(self):
-        painter = QPainter(self.image)
-        painter.setPen(QPen(self.pen_color, 1))
-        painter.setBrush(self.pen_color)
-        if self.isLine:
-            self.drawLine(painter, self.start_pos, self.end_pos, finalize=True)
-        elif self.isRectangle:
-            self.drawRectangle(painter, self.start_pos, self.end_pos)
-        elif self.isEllipse:
-            self.drawEllipse(painter, self.start_pos, self.end_pos)
-        painter.end()
+        self.markDirty(*self.shape_rect.getRect())
+        self.preview = None
+        self.journalRecord(Journal.SHAPE, shape_names.index(self.currentShape()), self.start_pos.x(), self.start_pos.y(),
+                           self.end_pos.x(), self.end_pos.y())
+        self.engine.drawShape(self.currentShape(), self.start_pos.x(), self.start_pos.y(),
+                              self.end_pos.x(), self.end_pos.y(), self.pen_color.rgba())
 
-    def drawLine(self, painter, start, end, finalize=False): # Bresenham's algorithm
-        x1, y1 = start.x() // self.cell_size, start.y() // self.cell_size
-        x2, y2 = end.x() // self.cell_size, end.y() // self.cell_size
-        dx = abs(x2 - x1)
-        dy = abs(y2 - y1)
-        sx = 1 if x1 < x2 else -1
-        sy = 1 if y1 < y2 else -1
-        err = dx - dy
-
-        while True:
-            cell_x = x1 * self.cell_size
-            cell_y = y1 * self.cell_size
-            painter.fillRect(cell_x, cell_y, self.cell_size, self.cell_size, self.pen_color)
-            if x1 == x2 and y1 == y2:
-                break
-            e2 = err * 2
-            if e2 > -dy:
-                err -= dy
-                x1 += sx
-            if e2 < dx:
-                err += dx
-                y1 += sy
-
-    def drawRectangle(self, painter, start, end):
-        x1, y1 = start.x(), start.y()
-        x2, y2 = end.x(), end.y()
-        x1, x2 = min(x1, x2), max(x1, x2)
-        y1, y2 = min(y1, y2), max(y1, y2)
-
-        for x in range(x1, x2 + self.cell_size, self.cell_size):
-            painter.fillRect(x, y1, self.cell_size, self.cell_size, self.pen_color)
-            painter.fillRect(x, y2, self.cell_size, self.cell_size, self.pen_color)
-        
-        for y in range(y1 + self.cell_size, y2, self.cell_size):
-            painter.fillRect(x1, y, self.cell_size, self.cell_size, self.pen_color)
-            painter.fillRect(x2, y, self.cell_size, self.cell_size, self.pen_color)
-
-    def drawEllipse(self, painter, start, end): # midpoint algorithm
-        x1, y1 = start.x(), start.y()
-        x2, y2 = end.x(), end.y()
-        x1, x2 = min(x1, x2), max(x1, x2)
-        y1, y2 = min(y1, y2), max(y1, y2)
-
-        rx = (x2 - x1) // 2
-        ry = (y2 - y1) // 2
-        cx = x1 + rx
-        cy = y1 + ry
-
-        x, y = 0, ry
-        dx, dy = 0, 2 * rx * rx * y
-        p1 = ry * ry - (rx * rx * ry) + (0.25 * rx * rx)
-        while dx < dy:
-            self.fillEllipseCells(painter, cx, cy, x, y)
-            x += self.cell_size
-            dx += 2 * ry * ry
-            if p1 < 0:
-                p1 += dx + ry * ry
-            else:
-                y -= self.cell_size
-                dy -= 2 * rx * rx
-                p1 += dx - dy + ry * ry
-
-        p2 = (ry * ry) * (x + 0.5) ** 2 + (rx * rx) * (y - 1) ** 2 - (rx * rx * ry * ry)
-        while y >= 0:
-            self.fillEllipseCells(painter, cx, cy, x, y)
-            y -= self.cell_size
-            dy -= 2 * rx * rx
-            if p2 > 0:
-                p2 += rx * rx - dy
-            else:
-                x += self.cell_size
-                dx += 2 * ry * ry
-                p2 += dx - dy + rx * rx
-
-    def fillEllipseCells(self, painter, cx, cy, x, y):
-        painter.fillRect(cx + x, cy + y, self.cell_size, self.cell_size, self.pen_color)
-        painter.fillRect(cx - x, cy + y, self.cell_size, self.cell_size, self.pen_color)
-        painter.fillRect(cx + x, cy - y, self.cell_size, self.cell_size, self.pen_color)
-        painter.fillRect(cx - x, cy - y, self.cell_size, self.cell_size, self.pen_color)
-    
     def changeToPen(self):
         self.setDrawingMode(1)
         self.setCustomCursor("icons/cursor.png")
@@ -358,44 +595,61 @@ class Canvas(QLabel):
         self.setDrawingMode(6)
         self.setCustomCursor("icons/cursor_shape.png")
 
+    def changeToSelect(self):
+        self.setDrawingMode(7)
+        self.setCustomCursor("icons/cursor_shape.png")
+
+    def changeToEyedropper(self):
+        self.setDrawingMode(8)
+        self.setCustomCursor("icons/eyedropper.png")
+
     def setDrawingMode(self, action):
+        if action != 7 and (self.floating or self.selection): # the selection belongs to the select tool
+            self.deselect()
+        self.drawing_mode = action
+        self.journalRecord(Journal.TOOL, action)
         self.isDrawing = action == 1
         self.isErasing = action == 2
         self.isFilling = action == 3
         self.isLine = action == 4
         self.isRectangle = action == 5
         self.isEllipse = action == 6
+        self.isSelecting = action == 7
+        self.isPicking = action == 8
+        self.toolChanged.emit(action)
 
     def setCustomCursor(self, icon_path, size=32):
         cursor_pixmap = QPixmap(icon_path).scaled(size, size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
         self.setCursor(QCursor(cursor_pixmap))
 
     def saveState(self):
-        if self.undo_stack and self.image.toImage() == self.undo_stack[-1].toImage(): # avoid duplicates
-            return
-        if len(self.undo_stack) > 50:
-            self.undo_stack.pop(0)
-        self.undo_stack.append(self.image.copy())
-        self.redo_stack.clear()
+        with stats.timer("save_state"):
+            self.journalRecord(Journal.BEGIN)
+            self.engine.saveState()
+
+    def commitState(self):
+        with stats.timer("commit_state"):
+            self.journalRecord(Journal.COMMIT)
+            self.engine.commitState()
 
     def undo(self):
-        if self.undo_stack:
-            if hasattr(self, "last_pos") and self.last_pos:
-                self.saveState() # handles active drawing
-            self.redo_stack.append(self.image.copy())
-            self.image = self.undo_stack.pop()
-            self.update()
+        self.flushInput()
+        self.dropFloating()
+        self.setSelection(None) # a moved or pasted selection no longer matches the cells once they go back
+        self.journalRecord(Journal.UNDO)
+        self.engine.undo()
+        self.flushDirty()
 
     def redo(self):
-        if self.redo_stack:
-            if hasattr(self, "last_pos") and self.last_pos:  # handles active drawing
-                self.saveState()
-            self.undo_stack.append(self.image.copy())
-            self.image = self.redo_stack.pop()
-            self.update()
+        self.flushInput()
+        self.dropFloating()
+        self.setSelection(None) # a moved or pasted selection no longer matches the cells once they go back
+        self.journalRecord(Journal.REDO)
+        self.engine.redo()
+        self.flushDirty()
     
     def resizeCanvas(self, grid_size):
-        return self.pixmap().scaled(grid_size, grid_size, Qt.KeepAspectRatio)
+        return self.engine.flatten().scaled(grid_size, grid_size, Qt.KeepAspectRatio)
     
     def zoom(self, zoom_factor):
         self.zoom_level *= zoom_factor
@@ -413,9 +667,387 @@ class Canvas(QLabel):
         color.setAlpha(value)
         self.current_opac = value
         self.pen_color = color
+        self.journalRecord(Journal.COLOR, color.rgba())
         self.setFocus()
 
+    def addLayer(self):
+        self.journalRecord(Journal.LAYER_ADD)
+        self.engine.addLayer()
+        self.flushDirty()
+
+    def removeLayer(self, index):
+        self.journalRecord(Journal.LAYER_REMOVE, index)
+        self.engine.removeLayer(index)
+        self.flushDirty()
+
+    def moveLayer(self, index, new_index):
+        self.journalRecord(Journal.LAYER_MOVE, index, new_index)
+        self.engine.moveLayer(index, new_index)
+        self.flushDirty()
+
+    def selectLayer(self, index):
+        self.journalRecord(Journal.LAYER_SELECT, index)
+        self.engine.setActiveLayer(index)
+        self.flushDirty()
+
+    def setLayerProps(self, index, visible, opacity, blend_mode): # opacity is 0-255 like changeOpac
+        self.journalRecord(Journal.LAYER_PROPS, index, visible, opacity, blend_names.index(blend_mode))
+        self.engine.setLayerVisible(index, visible)
+        self.engine.setLayerOpacity(index, opacity)
+        self.engine.setLayerBlend(index, blend_mode)
+        self.flushDirty()
+
+    def setPenSize(self, value):
+        self.pen_size = value
+        self.journalRecord(Journal.PEN_SIZE, value)
+
+    def setIndexed(self, palette, layers=None): # ARGB entries with 0 kept for transparency, None back to true colour
+        if self.journal:
+            self.journal.recordIndexed(palette)
+        self.engine.setIndexed(palette, layers)
+        self.flushDirty()
+
+    def recolor(self, old, new): # every old pixel becomes new, only the palette entry changes in indexed mode
+        self.saveState()
+        self.journalRecord(Journal.RECOLOR, old, new)
+        self.engine.remap({old: new})
+        self.commitState()
+        self.flushDirty()
+
+    def setFilterPreview(self, image): # a filtered copy of the active layer shown over the canvas, None removes it
+        self.preview = None if image is None else (QRect(0, 0, image.width(), image.height()), image)
+        self.markDirty(0, 0, self.engine.width, self.engine.height)
+        self.flushDirty()
+
+    def applyPixels(self, pixels): # ARGB32 replacement for the active layer, only the box around changed cells is written, as one undo step
+        changed = pixels != self.engine.layerPixels()
+        if not changed.any():
+            return
+        rows = np.flatnonzero(changed.any(axis=1))
+        cols = np.flatnonzero(changed.any(axis=0))
+        left, top = int(cols[0]), int(rows[0])
+        block = pixels[top:int(rows[-1]) + 1, left:int(cols[-1]) + 1]
+        self.saveState()
+        if self.journal:
+            self.journal.recordRect(left, top, block)
+        self.engine.writePixels(left, top, block)
+        self.commitState()
+        self.flushDirty()
+
+    def resetFrames(self): # the engine's layers become the only frame, with nothing selected
+        self.timeline.reset()
+        self.onion_images = []
+        self.floating = None
+        self.preview = None
+        self.setSelection(None)
+
+    def leaveFrame(self): # queued input and the floating selection land in the frame they were made in
+        self.flushInput()
+        self.dropFloating()
+
+    def selectFrame(self, index): # undo history does not carry over to another frame
+        self.leaveFrame()
+        self.journalRecord(Journal.FRAME_SELECT, index)
+        self.timeline.select(index)
+        self.updateOnion()
+
+    def addFrame(self, copy=False):
+        self.leaveFrame()
+        self.journalRecord(Journal.FRAME_ADD, copy)
+        self.timeline.addFrame(copy)
+        self.updateOnion()
+
+    def removeFrame(self):
+        self.leaveFrame()
+        self.journalRecord(Journal.FRAME_REMOVE)
+        self.timeline.removeFrame()
+        self.updateOnion()
+
+    def setOnionSkin(self, shown):
+        self.onion_skin = shown
+        self.updateOnion()
+
+    def updateOnion(self):
+        timeline = self.timeline
+        neighbours = [timeline.current - 1, timeline.current + 1] if self.onion_skin else []
+        self.onion_images = [timeline.image(index) for index in neighbours if 0 <= index < len(timeline)]
+        self.render_cache.clear()
+        self.updateTransform()
+
+class PlaybackDialog(QDialog): # frames rendered and scaled once up front, then only swapped at the chosen rate
+    MAX_SIZE = 512 # widget pixels on the longer side, frames are scaled by a whole factor below it
+
+    def __init__(self, images, fps, parent):
+        super().__init__(parent)
+        self.setWindowTitle("Playback")
+        scale = max(1, self.MAX_SIZE // max(images[0].width(), images[0].height()))
+        self.pixmaps = [QPixmap.fromImage(image.scaled(image.width() * scale, image.height() * scale,
+                                                       Qt.IgnoreAspectRatio, Qt.FastTransformation)) for image in images]
+        self.frame = 0
+        self.view = QLabel(self)
+        self.view.setAlignment(Qt.AlignCenter)
+        self.view.setStyleSheet("background-color: white;")
+        self.view.setPixmap(self.pixmaps[0])
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.view)
+        self.timer = QTimer(self)
+        self.timer.setTimerType(Qt.PreciseTimer)
+        self.timer.timeout.connect(self.nextFrame)
+        self.timer.start(round(1000 / fps))
+
+    def nextFrame(self):
+        self.frame = (self.frame + 1) % len(self.pixmaps)
+        self.view.setPixmap(self.pixmaps[self.frame])
+
+class Minimap(QWidget): # the composite at actual size, or repeated to check seamless tiles, drawn from the engine's cached tiles
+    MAX_SIZE = 256 # widget pixels on the longer side, larger canvases are shown at 1/2, 1/4, ...
+    cellClicked = pyqtSignal(QPoint)
+
+    def __init__(self, canvas, repeat=1, parent=None):
+        super().__init__(parent)
+        self.canvas = canvas
+        self.repeat = repeat
+        self.viewport = QRect() # cells visible in the scroll area, outlined on a 1:1 map
+        self.factor = 1 # cells per widget pixel
+        self.resizeToCanvas()
+        canvas.pixelsChanged.connect(self.updateCells)
+
+    def resizeToCanvas(self):
+        engine = self.canvas.engine
+        self.size_cells = QSize(engine.width, engine.height)
+        self.factor = 1
+        while max(engine.width, engine.height) * self.repeat > self.MAX_SIZE * self.factor:
+            self.factor *= 2
+        self.setFixedSize(self.cellsToWidget(QRect(0, 0, engine.width * self.repeat, engine.height * self.repeat)).size())
+
+    def cellsToWidget(self, rect):
+        left, top = rect.x() // self.factor, rect.y() // self.factor
+        right, bottom = -(-(rect.right() + 1) // self.factor), -(-(rect.bottom() + 1) // self.factor)
+        return QRect(left, top, right - left, bottom - top)
+
+    def updateCells(self, rect): # only the changed cells, in every repeat
+        engine = self.canvas.engine
+        if self.size_cells != QSize(engine.width, engine.height):
+            self.resizeToCanvas()
+            self.update()
+            return
+        region = QRegion()
+        for row in range(self.repeat):
+            for column in range(self.repeat):
+                region += self.cellsToWidget(rect.translated(column * engine.width, row * engine.height))
+        self.update(region)
+
+    def setViewport(self, rect):
+        if self.repeat == 1:
+            self.update(self.cellsToWidget(self.viewport).adjusted(-1, -1, 1, 1))
+            self.viewport = rect
+            self.update(self.cellsToWidget(rect).adjusted(-1, -1, 1, 1))
+
+    def paintEvent(self, e):
+        engine = self.canvas.engine
+        painter = QPainter(self)
+        painter.fillRect(e.rect(), Qt.white)
+        painter.scale(1 / self.factor, 1 / self.factor)
+        exposed = QRect(e.rect().topLeft() * self.factor, e.rect().size() * self.factor)
+        layer = engine.activeLayer()
+        for row in range(self.repeat):
+            for column in range(self.repeat):
+                offset = QPoint(column * engine.width, row * engine.height)
+                cells = exposed.translated(-offset).intersected(QRect(0, 0, engine.width, engine.height))
+                for tx, ty in layer.tileKeys(*cells.getRect()):
+                    image = engine.compositeTile(tx, ty)
+                    if image is not None:
+                        painter.drawImage(layer.tileRect(tx, ty).topLeft() + offset, image)
+        if self.repeat == 1 and not self.viewport.isEmpty():
+            painter.resetTransform()
+            painter.setPen(QPen(Qt.red, 0))
+            painter.drawRect(self.cellsToWidget(self.viewport).adjusted(0, 0, -1, -1))
+        painter.end()
+
+    def mousePressEvent(self, e):
+        self.mouseMoveEvent(e)
+
+    def mouseMoveEvent(self, e): # dragging keeps scrolling
+        if e.buttons() & Qt.LeftButton:
+            x, y = e.x() * self.factor, e.y() * self.factor
+            self.cellClicked.emit(QPoint(x % self.size_cells.width(), y % self.size_cells.height()))
+
+class JobDialog(QProgressDialog): # progress of a background ImageJob, polled on a timer so the GUI thread never waits on it
+    def __init__(self, job, label, callback, parent, modal=False):
+        _, total = job.progress()
+        super().__init__(label, "Cancel", 0, total if total > 1 else 0, parent) # a single task that reports no bytes shows a busy bar
+        self.job = job
+        self.callback = callback # called with the job once every task has finished or been cancelled
+        self.setWindowModality(Qt.WindowModal if modal else Qt.NonModal)
+        self.setMinimumDuration(0 if modal else 300)
+        if modal: # block the window at once, input in the first 300 ms would race the job
+            self.show()
+        self.setAutoReset(False)
+        self.canceled.connect(job.cancel)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll)
+        self.timer.start(50)
+
+    def poll(self):
+        if self.maximum():
+            self.setValue(self.job.progress()[0])
+        if self.job.finished():
+            self.timer.stop()
+            self.canceled.disconnect(self.job.cancel) # closing the dialog emits canceled
+            self.reset()
+            self.callback(self.job)
+            self.deleteLater()
+
+class ExportDialog(QDialog): # scales and formats written by one export
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setWindowTitle("Export")
+        layout = QVBoxLayout(self)
+        self.scale_boxes = self.addChoices(layout, "Scales:", [(f"{scale}x", scale) for scale in export_scales], [1])
+        self.format_boxes = self.addChoices(layout, "Formats:", [(name.upper(), name) for name in export_formats], ["png"])
+        self.pixel_art_box = QCheckBox("Scale2x/Scale3x smoothing of diagonal edges", self)
+        layout.addWidget(self.pixel_art_box)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addWidget(buttons)
+
+    def addChoices(self, layout, title, choices, checked):
+        row = QHBoxLayout()
+        row.addWidget(QLabel(title, self))
+        boxes = []
+        for text, value in choices:
+            box = QCheckBox(text, self)
+            box.setChecked(value in checked)
+            box.value = value
+            row.addWidget(box)
+            boxes.append(box)
+        layout.addLayout(row)
+        return boxes
+
+    def selection(self): # (scales, formats, scaler)
+        return ([box.value for box in self.scale_boxes if box.isChecked()],
+                [box.value for box in self.format_boxes if box.isChecked()],
+                scalePixelArt if self.pixel_art_box.isChecked() else None)
+
+class FilterDialog(QDialog): # filter settings with a live preview, recomputed in the background whenever one changes
+    def __init__(self, canvas, palette, parent):
+        super().__init__(parent)
+        self.setWindowTitle("Filters")
+        self.canvas = canvas
+        self.palette = palette # ARGB colours the dithers pick from
+        self.pixels = canvas.engine.layerPixels()
+        self.job = None
+        self.result = None
+        layout = QFormLayout(self)
+        self.filter_box = QComboBox(self)
+        self.filter_box.addItems(list(filters))
+        self.filter_box.currentIndexChanged.connect(self.showParams)
+        self.filter_box.currentIndexChanged.connect(self.restart)
+        layout.addRow("Filter:", self.filter_box)
+        self.dx_box = self.addSpinBox(layout, "Shadow x:")
+        self.dy_box = self.addSpinBox(layout, "Shadow y:")
+        self.hue_slider = QSlider(Qt.Horizontal, self)
+        self.hue_slider.setRange(-180, 180)
+        self.hue_slider.valueChanged.connect(self.restart)
+        layout.addRow("Hue:", self.hue_slider)
+        self.param_widgets = {"Drop shadow": [self.dx_box, self.dy_box], "Hue shift": [self.hue_slider]} # rows shown per filter
+        self.progress = QProgressBar(self)
+        layout.addRow(self.progress)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.poll)
+        self.showParams()
+        self.restart()
+
+    def showParams(self, *_): # only the rows the chosen filter reads
+        chosen = self.param_widgets.get(self.filter_box.currentText(), [])
+        for widgets in self.param_widgets.values():
+            for widget in widgets:
+                widget.setVisible(widget in chosen)
+                self.layout().labelForField(widget).setVisible(widget in chosen)
+        self.adjustSize()
+
+    def addSpinBox(self, layout, label):
+        box = QSpinBox(self)
+        box.setRange(-8, 8)
+        box.setValue(1)
+        box.valueChanged.connect(self.restart)
+        layout.addRow(label, box)
+        return box
+
+    def params(self): # keyword arguments of the chosen filter, outline and shadow use the pen colour
+        name = self.filter_box.currentText()
+        color = self.canvas.pen_color.rgba()
+        if name == "Outline":
+            return {"color": color}
+        if name == "Drop shadow":
+            return {"color": color, "dx": self.dx_box.value(), "dy": self.dy_box.value()}
+        if name == "Hue shift":
+            return {"degrees": self.hue_slider.value()}
+        return {"palette": self.palette}
+
+    def restart(self, *_): # the running job is dropped, tasks not started yet are skipped
+        if self.job:
+            self.job.cancel()
+        self.result = None
+        self.job = filterJob(self.pixels, self.filter_box.currentText(), **self.params())
+        self.progress.setRange(0, self.job.total)
+        self.progress.setValue(0)
+        self.timer.start(50)
+
+    def poll(self):
+        self.progress.setValue(self.job.done)
+        if self.job.finished():
+            self.timer.stop()
+            self.result = filterResult(self.pixels, self.job)
+            image = QImage(self.result.shape[1], self.result.shape[0], QImage.Format_ARGB32)
+            imageArray(image)[:] = self.result
+            self.canvas.setFilterPreview(image)
+
+    def done(self, result): # OK waits for a preview still being computed, both buttons remove it
+        self.timer.stop()
+        if result and self.result is None:
+            self.result = filterResult(self.pixels, self.job)
+        elif not result:
+            self.job.cancel()
+        self.canvas.setFilterPreview(None)
+        if result:
+            self.canvas.applyPixels(self.result)
+        super().done(result)
+
+class ImportDialog(QDialog): # target grid and colour count of an imported image
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.setWindowTitle("Import")
+        layout = QFormLayout(self)
+        self.size_box = QSpinBox(self)
+        self.size_box.setRange(8, max_grid_size)
+        self.size_box.setValue(128)
+        self.size_box.setSuffix(" cells")
+        self.colors_box = QSpinBox(self)
+        self.colors_box.setRange(2, 256)
+        self.colors_box.setValue(32)
+        layout.addRow("Longest side:", self.size_box)
+        layout.addRow("Colours:", self.colors_box)
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel, self)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+
+    def selection(self): # (grid size, colours)
+        return self.size_box.value(), self.colors_box.value()
+
 class MainWindow(QMainWindow):
+    AUTOSAVE_INTERVAL = 60 # seconds between autosaves of an open project
+    STATS_INTERVAL = 500 # ms between stats bar updates
+    COLORS_INTERVAL = 250 # ms after the last edit before the colours panel is recounted
+    MAX_COLORS_SHOWN = 256 # swatches in the colours panel, the least used are left out
+    projectSaved = pyqtSignal(str) # error message, empty on success; emitted from the save worker
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("Paint")
@@ -426,6 +1058,51 @@ class MainWindow(QMainWindow):
         self.showMaximized()
         self.selected_tool_button = None
         self.selected_color_button = None
+        self.project = None # ProjectWriter of the open .itp file, autosaved while set
+        self.projectSaved.connect(self.projectSaveDone)
+        self.autosave_timer = QTimer(self)
+        self.autosave_timer.timeout.connect(self.autosave)
+        self.autosave_timer.start(self.AUTOSAVE_INTERVAL * 1000)
+        self.stats_label = QLabel(self)
+        self.statusBar().addWidget(self.stats_label)
+        self.statusBar().setVisible(False)
+        self.stats_timer = QTimer(self) # runs only while the stats bar is shown
+        self.stats_timer.timeout.connect(self.updateStats)
+        self.startJournal()
+
+    def journalPath(self): # ITPAINT_JOURNAL keeps the journal after exit, e.g. to reuse it as a workload
+        path = os.environ.get("ITPAINT_JOURNAL")
+        if path:
+            return path
+        folder = QStandardPaths.writableLocation(QStandardPaths.AppLocalDataLocation)
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, "session.journal")
+
+    def startJournal(self):
+        path = self.journalPath()
+        try:
+            if os.path.exists(path):
+                reader = JournalReader.open(path)
+                if reader.needsRecovery():
+                    answer = QMessageBox.question(self, "Recover", "The previous session did not close properly. Recover the unsaved drawing?")
+                    if answer == QMessageBox.Yes:
+                        replayer = self.canvas.replayJournal(reader)
+                        self.pen_size_slider.setValue(replayer.pen_size)
+                        self.opacity_slider.setValue(self.canvas.current_opac)
+                        self.refreshLayers()
+                        self.refreshFrames()
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Failed to recover the previous session. Error: {e}")
+        self.canvas.setJournal(JournalWriter(path))
+
+    def closeEvent(self, e):
+        self.closeProject()
+        journal = self.canvas.journal
+        if journal:
+            journal.close()
+            if not os.environ.get("ITPAINT_JOURNAL"):
+                os.remove(journal.path) # clean exit, nothing to recover
+        super().closeEvent(e)
 
     def setupUI(self):
         main_layout = QHBoxLayout()
@@ -448,18 +1125,24 @@ class MainWindow(QMainWindow):
             ("icons/line.png", self.canvas.changeToLine),
             ("icons/rectangle.png", self.canvas.changeToRectangle),
             ("icons/ellipse.png", self.canvas.changeToEllipse),
+            ("icons/select.png", self.canvas.changeToSelect),
+            ("icons/eyedropper.png", self.canvas.changeToEyedropper),
             ("icons/zoom_in.png", partial(self.canvas.zoom, 2)),
             ("icons/zoom_out.png", partial(self.canvas.zoom, 0.5)),
             ("icons/zoom_reset.png", self.canvas.resetZoom),
         ]
 
-        for icon_path, action in tools:
+        self.tool_buttons = {} # drawing mode -> button, the first eight tools above are modes 1 to 8
+        for mode, (icon_path, action) in enumerate(tools, 1):
             button = QPushButton(QIcon(icon_path), "", self)
             button.setFixedSize(85, 85)
             button.setIconSize(QSize(60, 60))
             button.setStyleSheet("background-color: white;")
             button.clicked.connect(lambda checked, btn=button, act=action: self.selectTool(btn, act))
             left_bar.addWidget(button)
+            if mode <= 8:
+                self.tool_buttons[mode] = button
+        self.canvas.toolChanged.connect(self.highlightTool)
         
         left_bar.addStretch()  # add stretch to push buttons to the top
 
@@ -478,10 +1161,111 @@ class MainWindow(QMainWindow):
         reset_zoom_shortcut_1.activated.connect(self.canvas.resetZoom)
         reset_zoom_shortcut_2.activated.connect(self.canvas.resetZoom)
 
+        delete_shortcut = QShortcut(QKeySequence.Delete, self)
+        delete_shortcut.activated.connect(self.canvas.deleteSelection)
+        deselect_shortcut = QShortcut(QKeySequence("Esc"), self) # drops a floating paste in place
+        deselect_shortcut.activated.connect(self.canvas.deselect)
+
         scroll_area = QScrollArea() # canvas / middle area
         scroll_area.setWidget(self.canvas)
         scroll_area.setWidgetResizable(True)
         scroll_area.setAlignment(Qt.AlignCenter)
+        self.scroll_area = scroll_area
+        scroll_area.horizontalScrollBar().valueChanged.connect(self.updateMinimapViewport)
+        scroll_area.verticalScrollBar().valueChanged.connect(self.updateMinimapViewport)
+        self.canvas.zoomChanged.connect(self.updateMinimapViewport)
+
+        preview_layout = QVBoxLayout() # docked 1:1 and 3x3 previews
+        self.minimaps = []
+        for title, repeat in [("1:1", 1), ("3x3", 3)]:
+            minimap = Minimap(self.canvas, repeat, self)
+            minimap.cellClicked.connect(self.scrollToCell)
+            preview_layout.addWidget(QLabel(title, self))
+            preview_layout.addWidget(minimap, alignment=Qt.AlignCenter)
+            self.minimaps.append(minimap)
+        preview_layout.addStretch()
+        preview_widget = QWidget(self)
+        preview_widget.setLayout(preview_layout)
+        preview_widget.setStyleSheet("color: black; background-color: #B0C4DE;")
+        self.preview_dock = QDockWidget("Preview", self)
+        self.preview_dock.setWidget(preview_widget)
+        self.addDockWidget(Qt.RightDockWidgetArea, self.preview_dock)
+
+        colors_layout = QVBoxLayout() # colours of the active layer, most used first
+        self.colors_label = QLabel(self)
+        self.colors_list = QListWidget(self)
+        self.colors_list.setViewMode(QListView.IconMode)
+        self.colors_list.setIconSize(QSize(20, 20))
+        self.colors_list.setSpacing(2)
+        self.colors_list.setMovement(QListView.Static)
+        self.colors_list.setResizeMode(QListView.Adjust)
+        self.colors_list.setStyleSheet("background-color: white;")
+        self.colors_list.itemClicked.connect(lambda item: self.pickColor(QColor.fromRgba(item.data(Qt.UserRole))))
+        color_buttons = QHBoxLayout()
+        for text, action in [("Select", self.selectUsedColor), ("Replace", self.replaceUsedColor)]:
+            button = QPushButton(text, self)
+            button.setStyleSheet("background-color: silver; font-weight: bold;")
+            button.clicked.connect(lambda checked, act=action: act())
+            color_buttons.addWidget(button)
+        colors_layout.addWidget(self.colors_label)
+        colors_layout.addWidget(self.colors_list)
+        colors_layout.addLayout(color_buttons)
+        colors_widget = QWidget(self)
+        colors_widget.setLayout(colors_layout)
+        colors_widget.setStyleSheet("color: black; background-color: #B0C4DE;")
+        self.colors_dock = QDockWidget("Colours", self)
+        self.colors_dock.setWidget(colors_widget)
+        self.colors_dock.visibilityChanged.connect(lambda visible: visible and self.refreshColors())
+        self.addDockWidget(Qt.RightDockWidgetArea, self.colors_dock)
+        self.colors_timer = QTimer(self) # one recount per burst of edits
+        self.colors_timer.setSingleShot(True)
+        self.colors_timer.setInterval(self.COLORS_INTERVAL)
+        self.colors_timer.timeout.connect(self.refreshColors)
+        self.canvas.pixelsChanged.connect(lambda _: self.colors_timer.start())
+        self.canvas.colorPicked.connect(self.pickColor)
+
+        frame_bar = QHBoxLayout() # animation timeline under the canvas
+        frame_bar_widget = QWidget()
+        frame_bar_widget.setLayout(frame_bar)
+        frame_bar_widget.setStyleSheet("background-color: #B0C4DE; border: 2px solid black;")
+
+        frames_label = QLabel("Frames:", self)
+        frames_label.setStyleSheet("color: black; border: none; font-weight: bold;")
+        self.frame_list = QListWidget(self) # one numbered cell per frame, left to right
+        self.frame_list.setFlow(QListView.LeftToRight)
+        self.frame_list.setFixedHeight(40)
+        self.frame_list.setStyleSheet("background-color: white; color: black;")
+        self.frame_list.currentRowChanged.connect(self.selectFrame)
+        frame_bar.addWidget(frames_label)
+        frame_bar.addWidget(self.frame_list, stretch=1)
+
+        frame_actions = [
+            ("Add", partial(self.addFrame, False)),
+            ("Copy", partial(self.addFrame, True)),
+            ("Delete", self.removeFrame),
+            ("Play", self.playFrames),
+        ]
+        for text, action in frame_actions:
+            button = QPushButton(text, self)
+            button.setFixedHeight(30)
+            button.setStyleSheet("background-color: silver; font-weight: bold;")
+            button.clicked.connect(lambda checked, act=action: act())
+            frame_bar.addWidget(button)
+
+        self.onion_checkbox = QCheckBox("Onion skin", self)
+        self.onion_checkbox.setStyleSheet("color: black; border: none;")
+        self.onion_checkbox.toggled.connect(self.changeOnionSkin)
+        self.fps_box = QSpinBox(self)
+        self.fps_box.setRange(1, 60)
+        self.fps_box.setValue(12)
+        self.fps_box.setSuffix(" fps")
+        self.fps_box.setStyleSheet("background-color: white; color: black;")
+        frame_bar.addWidget(self.onion_checkbox)
+        frame_bar.addWidget(self.fps_box)
+
+        center_bar = QVBoxLayout()
+        center_bar.addWidget(scroll_area, stretch=1)
+        center_bar.addWidget(frame_bar_widget)
 
         right_bar = QVBoxLayout()
         right_bar_widget = QWidget()
@@ -511,6 +1295,27 @@ class MainWindow(QMainWindow):
         self.opacity_value_label = QLabel(f"{255}", self)
         self.opacity_value_label.setStyleSheet("color: black; border: none; font-weight: bold;")
         self.opacity_value_label.setAlignment(Qt.AlignCenter)
+
+        fill_tolerance_label = QLabel("Fill Tolerance:", self)
+        fill_tolerance_label.setAlignment(Qt.AlignCenter)
+        fill_tolerance_label.setStyleSheet("color: black; border: none; font-weight: bold;")
+        self.fill_tolerance_slider = QSlider(Qt.Horizontal, self)
+        self.fill_tolerance_slider.setRange(0, 255)
+        self.fill_tolerance_slider.setValue(self.canvas.fill_tolerance)
+        self.fill_tolerance_slider.valueChanged.connect(self.changeFillTolerance)
+        self.fill_tolerance_slider.setStyleSheet("border: none;")
+        self.fill_tolerance_value_label = QLabel(str(self.canvas.fill_tolerance), self)
+        self.fill_tolerance_value_label.setStyleSheet("color: black; border: none; font-weight: bold;")
+        self.fill_tolerance_value_label.setAlignment(Qt.AlignCenter)
+        self.fill_all_checkbox = QCheckBox("Fill all matching colour", self)
+        self.fill_all_checkbox.setStyleSheet("color: black; border: none; font-weight: bold;")
+        self.fill_all_checkbox.toggled.connect(self.changeFillMode)
+        self.fill_shapes_checkbox = QCheckBox("Fill shapes", self)
+        self.fill_shapes_checkbox.setStyleSheet("color: black; border: none; font-weight: bold;")
+        self.fill_shapes_checkbox.toggled.connect(self.changeFillShapes)
+        self.indexed_checkbox = QCheckBox("Indexed colour", self) # pixels become indices into the colour buttons
+        self.indexed_checkbox.setStyleSheet("color: black; border: none; font-weight: bold;")
+        self.indexed_checkbox.toggled.connect(self.changeIndexed)
         
         colors = [ # base colors
             "#000000", "#ffffff", 
@@ -531,6 +1336,8 @@ class MainWindow(QMainWindow):
             color_button = QPushButton(self)
             color_button.setFixedSize(40, 40)
             color_button.color = color
+            color_button.setContextMenuPolicy(Qt.CustomContextMenu) # right click edits the colour, recolouring the canvas
+            color_button.customContextMenuRequested.connect(partial(self.editColor, color_button))
             if color: 
                 color_button.setStyleSheet(f"background-color: {color}; border: 2px solid darkslategray;")
                 #color_button.clicked.connect(lambda _, btn=color_button, col=color: self.selectColor(btn, col)) #add loop
@@ -540,6 +1347,7 @@ class MainWindow(QMainWindow):
                 color_button.setEnabled(False)
             self.color_buttons.append(color_button)
             color_grid.addWidget(color_button, i // 2, i % 2)
+        self.custom_color_buttons = self.color_buttons[len(colors):] # filled by Add Custom Color and imports
 
         right_bar.addWidget(pen_size_label)
         right_bar.addWidget(self.pen_size_slider)
@@ -547,6 +1355,12 @@ class MainWindow(QMainWindow):
         right_bar.addWidget(opacity_label)
         right_bar.addWidget(self.opacity_slider)
         right_bar.addWidget(self.opacity_value_label)
+        right_bar.addWidget(fill_tolerance_label)
+        right_bar.addWidget(self.fill_tolerance_slider)
+        right_bar.addWidget(self.fill_tolerance_value_label)
+        right_bar.addWidget(self.fill_all_checkbox)
+        right_bar.addWidget(self.fill_shapes_checkbox)
+        right_bar.addWidget(self.indexed_checkbox)
 
         right_bar.addLayout(color_grid)
 
@@ -555,10 +1369,51 @@ class MainWindow(QMainWindow):
         custom_color_button.setFixedSize(200, 30)
         custom_color_button.setStyleSheet("background-color: silver; font-weight: bold;")
         right_bar.addWidget(custom_color_button, alignment=Qt.AlignCenter)
+
+        layers_label = QLabel("Layers:", self)
+        layers_label.setAlignment(Qt.AlignCenter)
+        layers_label.setStyleSheet("color: black; border: none; font-weight: bold;")
+        self.layer_list = QListWidget(self) # top layer first
+        self.layer_list.setFixedHeight(120)
+        self.layer_list.setStyleSheet("background-color: white; color: black;")
+        self.layer_list.currentRowChanged.connect(self.selectLayer)
+        self.layer_list.itemChanged.connect(self.toggleLayerVisible)
+
+        layer_buttons = QHBoxLayout()
+        layer_actions = [
+            ("Add", self.addLayer),
+            ("Delete", self.removeLayer),
+            ("Up", partial(self.moveLayer, 1)),
+            ("Down", partial(self.moveLayer, -1)),
+        ]
+        for text, action in layer_actions:
+            button = QPushButton(text, self)
+            button.setFixedHeight(30)
+            button.setStyleSheet("background-color: silver; font-weight: bold;")
+            button.clicked.connect(lambda checked, act=action: act())
+            layer_buttons.addWidget(button)
+
+        self.layer_opacity_slider = QSlider(Qt.Horizontal, self)
+        self.layer_opacity_slider.setRange(0, 255)
+        self.layer_opacity_slider.setValue(255)
+        self.layer_opacity_slider.valueChanged.connect(self.changeLayerProps)
+        self.layer_opacity_slider.setStyleSheet("border: none;")
+        self.layer_blend_box = QComboBox(self)
+        self.layer_blend_box.addItems(list(blend_modes))
+        self.layer_blend_box.setStyleSheet("background-color: white; color: black;")
+        self.layer_blend_box.currentIndexChanged.connect(self.changeLayerProps)
+
+        right_bar.addWidget(layers_label)
+        right_bar.addWidget(self.layer_list)
+        right_bar.addLayout(layer_buttons)
+        right_bar.addWidget(self.layer_opacity_slider)
+        right_bar.addWidget(self.layer_blend_box)
+        self.refreshLayers()
+        self.refreshFrames()
         right_bar.addStretch()
 
         main_layout.addWidget(left_bar_widget)
-        main_layout.addWidget(scroll_area, stretch=1)  # give the canvas majority space
+        main_layout.addLayout(center_bar, stretch=1)  # give the canvas majority space
         main_layout.addWidget(right_bar_widget)
 
         central_widget = QWidget()
@@ -585,6 +1440,26 @@ class MainWindow(QMainWindow):
         openAction.triggered.connect(self.openImage)
         menubar.addAction(openAction)
 
+        importAction = QAction("Import", self)
+        importAction.setShortcut("Ctrl+I")
+        importAction.triggered.connect(self.importImage)
+        menubar.addAction(importAction)
+
+        exportAction = QAction("Export", self)
+        exportAction.setShortcut("Ctrl+E")
+        exportAction.triggered.connect(self.exportCanvas)
+        menubar.addAction(exportAction)
+
+        animationAction = QAction("Export Animation", self)
+        animationAction.setShortcut("Ctrl+Shift+E")
+        animationAction.triggered.connect(self.exportAnimation)
+        menubar.addAction(animationAction)
+
+        filterAction = QAction("Filters", self)
+        filterAction.setShortcut("Ctrl+Shift+F")
+        filterAction.triggered.connect(self.openFilters)
+        menubar.addAction(filterAction)
+
         undoAction = QAction("Undo", self)
         undoAction.setShortcut("Ctrl+Z")
         undoAction.triggered.connect(self.canvas.undo)
@@ -595,11 +1470,49 @@ class MainWindow(QMainWindow):
         redoAction.triggered.connect(self.canvas.redo)
         menubar.addAction(redoAction)
 
+        gridAction = QAction("Grid", self)
+        gridAction.setShortcut("Ctrl+G")
+        gridAction.setCheckable(True)
+        gridAction.toggled.connect(self.canvas.setGrid)
+        menubar.addAction(gridAction)
+
+        cutAction = QAction("Cut", self)
+        cutAction.setShortcut("Ctrl+X")
+        cutAction.triggered.connect(self.canvas.cutSelection)
+        menubar.addAction(cutAction)
+
+        copyAction = QAction("Copy", self)
+        copyAction.setShortcut("Ctrl+C")
+        copyAction.triggered.connect(self.canvas.copySelection)
+        menubar.addAction(copyAction)
+
+        pasteAction = QAction("Paste", self)
+        pasteAction.setShortcut("Ctrl+V")
+        pasteAction.triggered.connect(self.canvas.paste)
+        menubar.addAction(pasteAction)
+
+        previewAction = self.preview_dock.toggleViewAction()
+        previewAction.setShortcut("F4")
+        menubar.addAction(previewAction)
+
+        colorsAction = self.colors_dock.toggleViewAction()
+        colorsAction.setShortcut("F5")
+        menubar.addAction(colorsAction)
+
+        statsAction = QAction("Stats", self)
+        statsAction.setShortcut("F3")
+        statsAction.setCheckable(True)
+        statsAction.toggled.connect(self.showStats)
+        menubar.addAction(statsAction)
+
     def newCanvas(self):
-        grid_size, ok = QInputDialog.getInt(self, "New Canvas", "Enter the new canvas' size (default 64x64, min 8x8, max 256x256):", 64, 8, 256, 8)
+        grid_size, ok = QInputDialog.getInt(self, "New Canvas", f"Enter the new canvas' size (default 64x64, min 8x8, max {max_grid_size}x{max_grid_size}):", 64, 8, max_grid_size, 8)
         if ok:
+            self.closeProject()
             self.canvas.clearCanvas(grid_size, default_cell_size)
             self.canvas.updateTransform()
+            self.refreshLayers()
+            self.refreshFrames()
             self.showMaximized()
 
     def openColorDialog(self):
@@ -609,39 +1522,158 @@ class MainWindow(QMainWindow):
     
     def saveCanvas(self):
         try:
-            filePath, _ = QFileDialog.getSaveFileName(self, "Save Image", "", "PNG(*.png);;JPEG(*.jpg *.jpeg);;All Files(*.*) ")
-            if filePath:
-                scaled_image = self.canvas.image.scaled(self.canvas.width // self.canvas.cell_size, 
-                                                        self.canvas.height // self.canvas.cell_size, 
-                                                        Qt.IgnoreAspectRatio)
-                scaled_image.save(filePath)
+            filePath, _ = QFileDialog.getSaveFileName(self, "Save Image", "", "PNG(*.png);;JPEG(*.jpg *.jpeg);;ITPaint project(*.itp);;All Files(*.*) ")
+            if filePath.lower().endswith(".itp"):
+                self.saveProject(filePath)
+            elif filePath: # visible layers, one pixel per cell, encoded on a worker
+                JobDialog(saveJob(self.canvas.engine.flatten(), filePath), "Saving...", self.saveDone, self)
             else:
                 raise Exception("Failed to save the file.")
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Unable to save the image. Error: {e}")
 
-    def openImage(self):
+    def saveDone(self, job):
+        try:
+            job.results()
+        except Cancelled:
+            pass
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Unable to save the image. Error: {e}")
+
+    def exportCanvas(self):
+        dialog = ExportDialog(self)
+        if not dialog.exec_():
+            return
+        scales, formats, scaler = dialog.selection()
+        if not scales or not formats:
+            return
+        filePath, _ = QFileDialog.getSaveFileName(self, "Export Image", "", "All Files(*.*) ")
+        if filePath:
+            job = exportJob(self.canvas.engine.flatten(), filePath, scales, formats, scaler)
+            JobDialog(job, f"Exporting {job.total} files...", self.saveDone, self)
+
+    def exportAnimation(self): # GIF frames are encoded in parallel, the file is assembled in animationDone
+        filePath, _ = QFileDialog.getSaveFileName(self, "Export Animation", "", "Animated GIF(*.gif);;Sprite strip(*.png)")
+        if not filePath:
+            return
+        images = self.canvas.timeline.renderAll()
+        if filePath.lower().endswith(".gif"):
+            job = gifJob(images, self.fps_box.value())
+            callback = partial(self.animationDone, filePath, images[0].width(), images[0].height())
+            JobDialog(job, f"Encoding {job.total} frames...", callback, self)
+        else:
+            JobDialog(stripJob(images, filePath), "Exporting...", self.saveDone, self)
+
+    def animationDone(self, path, width, height, job):
         try:
-            imagePath, _ = QFileDialog.getOpenFileName(self, "Save Image", "", "PNG(*.png);;JPEG(*.jpg *.jpeg);;All Files(*.*) ")
-            if imagePath:
-                pixmap = QPixmap(imagePath)
-                if pixmap.isNull():
-                    raise Exception("Invalid image format.")
-                if pixmap.width() != pixmap.height():
-                    raise ValueError("The image must be square (width and height must be equal).")
-                    
-                grid_size = pixmap.width()
-                cell_size = self.canvas.cell_size
-                self.canvas.clearCanvas(grid_size, cell_size)
-                self.canvas.image = pixmap.scaled(grid_size * cell_size, grid_size * cell_size)
+            writeGif(path, width, height, job.results())
+        except Cancelled:
+            pass
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Unable to export the animation. Error: {e}")
 
+    def openImage(self):
+        try:
+            imagePath, _ = QFileDialog.getOpenFileName(self, "Save Image", "", "PNG(*.png);;JPEG(*.jpg *.jpeg);;ITPaint project(*.itp);;All Files(*.*) ")
+            if imagePath.lower().endswith(".itp"):
+                self.closeProject()
+                state, self.project = self.canvas.openProject(imagePath)
+                self.restoreState(state)
+                self.refreshLayers()
+                self.refreshFrames()
                 self.showMaximized()
+            elif imagePath: # decoded on a worker, loaded in openDone
+                JobDialog(openJob(imagePath), "Opening...", self.openDone, self, modal=True)
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Failed to open the image. Error: {e}")
+
+    def openDone(self, job):
+        try:
+            image, = job.results()
+            if max(image.width(), image.height()) > max_grid_size:
+                raise ValueError(f"The image must be at most {max_grid_size}x{max_grid_size}.")
+
+            self.closeProject()
+            self.canvas.loadImage(image)
+            self.refreshLayers()
+            self.refreshFrames()
+
+            self.showMaximized()
+        except Cancelled:
+            pass
         except Exception as e:
             QMessageBox.critical(self, "Error", f"Failed to open the image. Error: {e}")
 
     
+    def importImage(self): # any photo or sprite, shrunk to a grid and quantized on a worker
+        imagePath, _ = QFileDialog.getOpenFileName(self, "Import Image", "", "Images(*.png *.jpg *.jpeg *.bmp *.gif *.webp);;All Files(*.*) ")
+        if not imagePath:
+            return
+        dialog = ImportDialog(self)
+        if dialog.exec_():
+            JobDialog(importJob(imagePath, *dialog.selection()), "Importing...", self.importDone, self, modal=True)
+
+    def importDone(self, job):
+        try:
+            (image, palette), = job.results()
+            self.closeProject()
+            self.canvas.loadImage(image)
+            self.refreshLayers()
+            self.refreshFrames()
+            colors = [QColor.fromRgba(color).name() for color in palette] + [""] * len(self.custom_color_buttons)
+            for button, color in zip(self.custom_color_buttons, colors): # the most used colours, the rest left free
+                self.setColorButton(button, color)
+            self.showMaximized()
+        except Cancelled:
+            pass
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Failed to import the image. Error: {e}")
+
+    def openFilters(self): # dithers use the indexed palette, or the colour slots in true colour
+        self.canvas.flushInput()
+        self.canvas.dropFloating()
+        engine = self.canvas.engine
+        palette = engine.palette[1:] if engine.palette is not None else [QColor(button.color).rgba() for button in self.color_buttons if button.color]
+        FilterDialog(self.canvas, palette, self).exec_()
+
+    def projectState(self): # palette and tool settings stored next to the pixels
+        return {"tool": self.canvas.toolState(), "palette": [button.color for button in self.color_buttons]}
+
+    def restoreState(self, state):
+        tool = state["tool"]
+        color = QColor.fromRgba(tool["color"])
+        self.canvas.setDrawingMode(tool["mode"])
+        self.opacity_slider.setValue(color.alpha())
+        self.canvas.setPenColor(color.name())
+        self.pen_size_slider.setValue(tool["pen_size"])
+        self.fill_tolerance_slider.setValue(tool["fill_tolerance"])
+        self.fill_all_checkbox.setChecked(not tool["fill_contiguous"])
+        self.fill_shapes_checkbox.setChecked(tool.get("fill_shapes", False)) # missing in older projects
+        for button, color in zip(self.color_buttons, state["palette"]):
+            self.setColorButton(button, color)
+
+    def saveProject(self, path): # compression and writing happen on the project's worker thread
+        if self.project is None or self.project.path != path:
+            self.closeProject()
+            self.project = ProjectWriter(path)
+        future = self.project.save(self.canvas.engine, self.projectState())
+        future.add_done_callback(lambda f: self.projectSaved.emit(str(f.exception() or "")))
+
+    def projectSaveDone(self, error):
+        if error:
+            QMessageBox.critical(self, "Error", f"Unable to save the project. Error: {error}")
+
+    def autosave(self):
+        if self.project and self.project.needsSave(self.canvas.engine, self.projectState()):
+            self.saveProject(self.project.path)
+
+    def closeProject(self): # waits for a save still in flight
+        if self.project:
+            self.project.close()
+            self.project = None
+
     def changePenSize(self, value):
-        self.canvas.pen_size = value
+        self.canvas.setPenSize(value)
         self.pen_size_value_label.setText(f"{value}")
         self.canvas.setFocus()
 
@@ -649,23 +1681,165 @@ class MainWindow(QMainWindow):
         self.opacity_value_label.setText(f"{value}")
         self.canvas.changeOpac(value)
 
+    def changeFillTolerance(self, value):
+        self.canvas.fill_tolerance = value
+        self.fill_tolerance_value_label.setText(f"{value}")
+        self.canvas.setFocus()
+
+    def changeFillMode(self, checked):
+        self.canvas.fill_contiguous = not checked
+        self.canvas.setFocus()
+
+    def changeFillShapes(self, checked):
+        self.canvas.fill_shapes = checked
+        self.canvas.setFocus()
+
+    def changeIndexed(self, checked): # layers are converted on workers, the canvas waits behind a modal progress dialog
+        palette = [0] + [QColor(button.color).rgba() for button in self.color_buttons if button.color] if checked else None
+        self.canvas.flushInput()
+        self.canvas.dropFloating()
+        self.canvas.engine.commitState()
+        job = indexedJob(self.canvas.engine.layers, palette) # a snapshot, so nothing may edit the layers until indexedDone
+        self.canvas.setEnabled(False)
+        JobDialog(job, "Converting layers...", partial(self.indexedDone, palette), self, modal=True)
+
+    def indexedDone(self, palette, job):
+        self.canvas.setEnabled(True)
+        try:
+            self.canvas.setIndexed(palette, job.results())
+        except Cancelled:
+            pass
+        except Exception as e:
+            QMessageBox.critical(self, "Error", f"Failed to convert the layers. Error: {e}")
+        self.refreshLayers() # the checkbox follows the engine, also when the conversion was cancelled
+        self.canvas.setFocus()
+
+    def layerRow(self, index): # list rows run top to bottom, layers bottom to top
+        return len(self.canvas.engine.layers) - 1 - index
+
+    def refreshLayers(self):
+        engine = self.canvas.engine
+        widgets = [self.layer_list, self.layer_opacity_slider, self.layer_blend_box, self.indexed_checkbox]
+        for widget in widgets:
+            widget.blockSignals(True)
+        self.layer_list.clear()
+        for layer in reversed(engine.layers):
+            item = QListWidgetItem(layer.name)
+            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
+            item.setCheckState(Qt.Checked if layer.visible else Qt.Unchecked)
+            self.layer_list.addItem(item)
+        self.layer_list.setCurrentRow(self.layerRow(engine.active))
+        self.layer_opacity_slider.setValue(engine.activeLayer().opacity)
+        self.layer_blend_box.setCurrentText(engine.activeLayer().blend_mode)
+        self.indexed_checkbox.setChecked(engine.palette is not None)
+        for widget in widgets:
+            widget.blockSignals(False)
+
+    def addLayer(self):
+        self.canvas.addLayer()
+        self.refreshLayers()
+
+    def removeLayer(self):
+        self.canvas.removeLayer(self.canvas.engine.active)
+        self.refreshLayers()
+
+    def moveLayer(self, step): # +1 moves the active layer up
+        index = self.canvas.engine.active
+        self.canvas.moveLayer(index, index + step)
+        self.refreshLayers()
+
+    def selectLayer(self, row):
+        if row >= 0:
+            self.canvas.selectLayer(self.layerRow(row))
+            self.refreshLayers()
+
+    def toggleLayerVisible(self, item):
+        index = self.layerRow(self.layer_list.row(item))
+        layer = self.canvas.engine.layers[index]
+        self.canvas.setLayerProps(index, item.checkState() == Qt.Checked, layer.opacity, layer.blend_mode)
+
+    def changeLayerProps(self, _):
+        engine = self.canvas.engine
+        self.canvas.setLayerProps(engine.active, engine.activeLayer().visible,
+                                  self.layer_opacity_slider.value(), self.layer_blend_box.currentText())
+        self.canvas.setFocus()
+
+    def refreshFrames(self):
+        timeline = self.canvas.timeline
+        self.frame_list.blockSignals(True)
+        self.frame_list.clear()
+        self.frame_list.addItems([str(index + 1) for index in range(len(timeline))])
+        self.frame_list.setCurrentRow(timeline.current)
+        self.frame_list.blockSignals(False)
+
+    def frameChanged(self): # a new layer stack is loaded
+        self.refreshLayers()
+        self.refreshFrames()
+        self.canvas.setFocus()
+
+    def selectFrame(self, row):
+        if row >= 0 and row != self.canvas.timeline.current:
+            self.canvas.selectFrame(row)
+            self.frameChanged()
+
+    def addFrame(self, copy):
+        self.canvas.addFrame(copy)
+        self.frameChanged()
+
+    def removeFrame(self):
+        self.canvas.removeFrame()
+        self.frameChanged()
+
+    def changeOnionSkin(self, checked):
+        self.canvas.setOnionSkin(checked)
+        self.canvas.setFocus()
+
+    def playFrames(self):
+        PlaybackDialog(self.canvas.timeline.renderAll(), self.fps_box.value(), self).exec_()
+
     def addCustomColor(self):
         color = QColorDialog.getColor()
         if color.isValid():
             for button in self.color_buttons:
                 if not button.isEnabled():
-                    button.color = color.name()
-                    button.setStyleSheet(f"background-color: {color.name()}; border: 2px solid darkslategray;")
-                    button.clicked.connect(partial(self.selectColor, button, color.name()))
-                    button.setEnabled(True)
+                    self.setColorButton(button, color.name())
                     break
+
+    def editColor(self, button, _):
+        if not button.color:
+            return
+        color = QColorDialog.getColor(QColor(button.color), self)
+        if color.isValid() and color.name() != button.color:
+            self.canvas.recolor(QColor(button.color).rgba(), color.rgba())
+            self.setColorButton(button, color.name())
+            if self.selected_color_button is button: # keep drawing with the edited colour
+                self.selectColor(button, color.name())
+
+    def setColorButton(self, button, color): # an empty color leaves a free custom slot
+        if button.isEnabled():
+            button.clicked.disconnect()
+        button.color = color
+        if color:
+            button.setStyleSheet(f"background-color: {color}; border: 2px solid darkslategray;")
+            button.clicked.connect(partial(self.selectColor, button, color))
+            button.setEnabled(True)
+        else:
+            button.setStyleSheet(f"background-color: white; border: 2px solid darkslategray;")
+            button.setEnabled(False)
     
     def selectTool(self, button, action):
+        self.highlightButton(button)
+        action()
+
+    def highlightTool(self, mode): # follows tool switches the canvas makes on its own
+        if self.tool_buttons[mode] is not self.selected_tool_button:
+            self.highlightButton(self.tool_buttons[mode])
+
+    def highlightButton(self, button):
         if self.selected_tool_button: # reset highlight
             self.selected_tool_button.setStyleSheet("background-color: white;")
         button.setStyleSheet("background-color: lightblue; border: 2px solid darkblue;") # new highlight
         self.selected_tool_button = button
-        action()
 
     def selectColor(self, button, color):
         if self.selected_color_button: # reset highlight
@@ -674,10 +1848,77 @@ class MainWindow(QMainWindow):
         self.selected_color_button = button
         self.canvas.setPenColor(color)
 
+    def refreshColors(self): # counts come from the engine's per-tile index, only tiles written since the last call are recounted
+        if not self.colors_dock.isVisible():
+            return
+        counts = self.canvas.engine.colorCounts()
+        current = self.colors_list.currentItem()
+        current = current.data(Qt.UserRole) if current else None
+        self.colors_list.clear()
+        for color, count in sorted(counts.items(), key=lambda item: -item[1])[:self.MAX_COLORS_SHOWN]:
+            swatch = QPixmap(20, 20)
+            swatch.fill(QColor.fromRgba(color))
+            item = QListWidgetItem(QIcon(swatch), "")
+            item.setData(Qt.UserRole, color)
+            item.setToolTip(f"{QColor.fromRgba(color).name(QColor.HexArgb)}: {count} cells")
+            self.colors_list.addItem(item)
+            if color == current:
+                self.colors_list.setCurrentItem(item)
+        self.colors_label.setText(f"{len(counts)} colours")
+
+    def usedColor(self): # ARGB of the chosen swatch, None without one
+        item = self.colors_list.currentItem()
+        return item.data(Qt.UserRole) if item else None
+
+    def pickColor(self, color): # eyedropper and colour swatches
+        self.opacity_slider.setValue(color.alpha())
+        self.canvas.setPenColor(color.name())
+
+    def selectUsedColor(self):
+        if self.usedColor() is not None:
+            self.canvas.selectColorCells(self.usedColor())
+            self.canvas.setFocus()
+
+    def replaceUsedColor(self): # every cell of the chosen colour, as one undo step
+        old = self.usedColor()
+        if old is None:
+            return
+        color = QColorDialog.getColor(QColor.fromRgba(old), self, "Replace colour", QColorDialog.ShowAlphaChannel)
+        if color.isValid() and color.rgba() != old:
+            self.canvas.recolor(old, color.rgba())
+            self.refreshColors()
+
+    def showStats(self, shown):
+        self.statusBar().setVisible(shown)
+        if shown:
+            self.updateStats()
+            self.stats_timer.start(self.STATS_INTERVAL)
+        else:
+            self.stats_timer.stop()
+
+    def updateStats(self): # rates and averages cover the last second
+        mb = 1024 * 1024
+        self.stats_label.setText(
+            f"{stats.rate('paint'):.0f} fps | paint {stats.average('paint'):.2f} ms | "
+            f"stroke {stats.average('stroke'):.2f} ms | {stats.rate('input'):.0f} input events/s | "
+            f"history {self.canvas.engine.history_bytes / mb:.2f} MB | canvas {self.canvas.memoryBytes() / mb:.2f} MB")
+
+    def updateMinimapViewport(self, *_): # cells shown by the scroll area
+        rect = self.canvas.widgetToCells(self.scroll_area.viewport().rect().translated(-self.canvas.pos()))
+        for minimap in self.minimaps:
+            minimap.setViewport(rect)
+
+    def scrollToCell(self, cell): # centre the scroll area on a cell
+        scale = self.canvas.cell_size * self.canvas.zoom_level
+        viewport = self.scroll_area.viewport()
+        self.scroll_area.horizontalScrollBar().setValue(int((cell.x() + 0.5) * scale - viewport.width() / 2))
+        self.scroll_area.verticalScrollBar().setValue(int((cell.y() + 0.5) * scale - viewport.height() / 2))
+
     def updateZoomLabel(self, zoom_level):
         self.zoom_level_label.setText(f"Zoom:\n{int(zoom_level * 100)}%")
 
-app = QApplication(sys.argv)
-window = MainWindow()
-window.show()
-app.exec_()
\ No newline at end of file
+if __name__ == "__main__":
+    app = QApplication(sys.argv)
+    window = MainWindow()
+    window.show()
+    app.exec_()
\ No newline at end of file
@@ -0,0 +1,161 @@
+import os
+import json
+import zlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from PyQt5.QtCore import *
+from PyQt5.QtGui import *
+from paintengine import Layer, imageArray
+from paintstats import stats
+
+"""Project files (.itp): every layer stored as compressed tile chunks, so a save only appends the tiles that changed."""
+
+class Project:
+    MAGIC = b"ITPP\x01"
+    HEADER = struct.Struct("<QI") # offset and length of the current index, rewritten last so a torn save keeps the old one
+    COMPACT_RATIO = 2 # rewrite the whole file once it is this many times larger than its live data
+
+class ProjectWriter(Project): # snapshots are taken on the caller's thread, compression and file writes happen on a worker
+    def __init__(self, path):
+        self.path = path
+        self.known = set() # layers whose tiles are all in the file, only their unsaved tiles need writing
+        self.chunks = {} # layer -> {(tx, ty): (offset, length)}, owned by the worker
+        self.size = 0 # bytes of the file the chunk table describes, 0 before the first save
+        self.last_meta = None
+        self.failed = [] # (layer, tiles) of a save that did not reach the disk, written again by the next one
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="project-save") # saves run one at a time, in order
+
+    def needsSave(self, engine, state):
+        if self.failed or any(layer.unsaved or layer not in self.known for layer in engine.layers):
+            return True
+        return self.metadata(engine, state) != self.last_meta
+
+    def metadata(self, engine, state):
+        return {
+            "width": engine.width,
+            "height": engine.height,
+            "active": engine.active,
+            "palette": None if engine.palette is None else list(engine.palette), # colour table of Indexed8 tiles, copied as it changes in place
+            "layers": [{"name": layer.name, "visible": layer.visible, "opacity": layer.opacity, "blend_mode": layer.blend_mode}
+                       for layer in engine.layers],
+            "state": state, # palette and tool settings, whatever the caller wants restored
+        }
+
+    def snapshot(self, engine, state): # copy the tiles changed since the last save, cheap enough for the UI thread
+        layers = []
+        for layer in engine.layers:
+            keys = layer.unsaved if layer in self.known else layer.tiles.keys()
+            layers.append((layer, {key: imageArray(layer.tiles[key]).tobytes() for key in keys}))
+            layer.unsaved = set()
+        self.known = set(engine.layers)
+        self.last_meta = self.metadata(engine, state)
+        return layers, self.last_meta
+
+    def save(self, engine, state): # returns a future, done once the file is on disk
+        with stats.timer("project_snapshot"): # the part that blocks the caller
+            layers, meta = self.snapshot(engine, state)
+        return self.pool.submit(self.write, layers, meta)
+
+    def write(self, layers, meta): # runs on the worker
+        failed = dict(self.failed)
+        layers = [(layer, {**failed.get(layer, {}), **tiles}) for layer, tiles in layers] # newer tiles win
+        try:
+            chunks = {layer: {key: zlib.compress(data, 6) for key, data in tiles.items()} for layer, tiles in layers}
+            live = sum(length for layer, _ in layers for key, (_, length) in self.chunks.get(layer, {}).items()
+                       if key not in chunks[layer])
+            live += sum(len(data) for tiles in chunks.values() for data in tiles.values())
+            with stats.timer("project_write"):
+                if self.size == 0 or self.size > self.COMPACT_RATIO * (live + len(self.MAGIC) + self.HEADER.size):
+                    self.rewrite(layers, chunks, meta)
+                else:
+                    self.append(layers, chunks, meta)
+        except Exception:
+            self.failed = layers # chunks and size still describe the file on disk, only these tiles are missing from it
+            raise
+        self.failed = []
+
+    def append(self, layers, chunks, meta): # new chunks and index at the end, then point the header at the index
+        with open(self.path, "r+b") as f:
+            f.seek(self.size)
+            tables = {} # removed layers are garbage now
+            for layer, _ in layers:
+                table = tables[layer] = dict(self.chunks.get(layer, {}))
+                for key, data in chunks[layer].items():
+                    table[key] = (f.tell(), len(data))
+                    f.write(data)
+            size = self.writeIndex(f, layers, tables, meta)
+        self.chunks, self.size = tables, size
+
+    def rewrite(self, layers, chunks, meta): # full copy into a new file, old chunks read back from the current one
+        old = open(self.path, "rb") if self.size else None
+        temp_path = self.path + ".tmp"
+        try:
+            with open(temp_path, "w+b") as f:
+                f.write(self.MAGIC + self.HEADER.pack(0, 0))
+                tables = {}
+                for layer, _ in layers:
+                    table = tables[layer] = {}
+                    for key, (offset, length) in self.chunks.get(layer, {}).items():
+                        if key not in chunks[layer]:
+                            old.seek(offset)
+                            table[key] = (f.tell(), length)
+                            f.write(old.read(length))
+                    for key, data in chunks[layer].items():
+                        table[key] = (f.tell(), len(data))
+                        f.write(data)
+                size = self.writeIndex(f, layers, tables, meta)
+        finally:
+            if old:
+                old.close()
+        os.replace(temp_path, self.path)
+        self.chunks, self.size = tables, size
+
+    def writeIndex(self, f, layers, tables, meta): # returns the file size, the caller adopts tables once the file is complete
+        index = dict(meta, layers=[dict(info, chunks=[[tx, ty, offset, length] for (tx, ty), (offset, length) in tables[layer].items()])
+                                   for info, (layer, _) in zip(meta["layers"], layers)])
+        data = json.dumps(index).encode()
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+        f.seek(len(self.MAGIC))
+        f.write(self.HEADER.pack(offset, len(data)))
+        f.flush()
+        os.fsync(f.fileno())
+        return offset + len(data)
+
+    def close(self): # wait for saves still running
+        self.pool.shutdown(wait=True)
+
+def loadProject(path, engine): # fill engine from a project file, returns the saved state and a writer that continues the file
+    with stats.timer("project_read"), open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(Project.MAGIC):
+        raise ValueError("Not a project file.")
+    offset, length = Project.HEADER.unpack_from(data, len(Project.MAGIC))
+    index = json.loads(data[offset:offset + length])
+
+    writer = ProjectWriter(path)
+    palette = index.get("palette") # shared by every layer
+    layers = []
+    for info in index["layers"]:
+        layer = Layer(index["width"], index["height"], info["name"], palette)
+        layer.visible = info["visible"]
+        layer.opacity = info["opacity"]
+        layer.blend_mode = info["blend_mode"]
+        table = writer.chunks[layer] = {}
+        for tx, ty, chunk_offset, chunk_length in info["chunks"]:
+            image = layer.tile(tx, ty, create=True)
+            pixels = np.frombuffer(zlib.decompress(data[chunk_offset:chunk_offset + chunk_length]), layer.dtype)
+            imageArray(image)[:] = pixels.reshape(image.height(), image.width())
+            table[(tx, ty)] = (chunk_offset, chunk_length)
+        layers.append(layer)
+    engine.loadLayers(layers, index["active"])
+
+    writer.known = set(layers)
+    writer.size = offset + length
+    writer.last_meta = {key: value for key, value in index.items() if key != "layers"}
+    writer.last_meta["layers"] = [{key: value for key, value in info.items() if key != "chunks"} for info in index["layers"]]
+    return index["state"], writer
@@ -0,0 +1,78 @@
+import os
+import json
+import time
+import atexit
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+"""Timing and event counters for the hot paths, shown by the stats bar and dumped as JSON at exit with ITPAINT_STATS=path."""
+
+histogram_bounds = [0.25, 0.5, 1, 2, 4, 8, 16, 33, 66, 133, 266] # ms, upper edge of each bucket, one more bucket past the last
+
+class Stats: # safe to record from worker threads
+    WINDOW = 1.0 # seconds of recent samples behind the live rates and averages
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {} # name -> {"count", "total_ms", "max_ms", "histogram"} since start
+        self.events = {} # name -> total count since start
+        self.recent = {} # name -> deque of (time, ms) inside WINDOW, for timings and events alike
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, (time.perf_counter() - start) * 1000)
+
+    def record(self, name, ms):
+        bucket = next((i for i, bound in enumerate(histogram_bounds) if ms <= bound), len(histogram_bounds))
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = {"count": 0, "total_ms": 0.0, "max_ms": 0.0, "histogram": [0] * (len(histogram_bounds) + 1)}
+            timing["count"] += 1
+            timing["total_ms"] += ms
+            timing["max_ms"] = max(timing["max_ms"], ms)
+            timing["histogram"][bucket] += 1
+            self.addRecent(name, ms)
+
+    def count(self, name):
+        with self.lock:
+            self.events[name] = self.events.get(name, 0) + 1
+            self.addRecent(name, 0)
+
+    def addRecent(self, name, ms):
+        now = time.perf_counter()
+        samples = self.recent.setdefault(name, deque())
+        samples.append((now, ms))
+        while samples[0][0] < now - self.WINDOW:
+            samples.popleft()
+
+    def window(self, name): # samples still inside WINDOW
+        now = time.perf_counter()
+        with self.lock:
+            return [ms for at, ms in self.recent.get(name, ()) if at >= now - self.WINDOW]
+
+    def rate(self, name): # per second, over the last WINDOW
+        return len(self.window(name)) / self.WINDOW
+
+    def average(self, name): # ms, over the last WINDOW
+        samples = self.window(name)
+        return sum(samples) / len(samples) if samples else 0.0
+
+    def snapshot(self):
+        with self.lock:
+            timings = {name: dict(timing, histogram=list(timing["histogram"])) for name, timing in self.timings.items()}
+            return {"histogram_bounds_ms": histogram_bounds, "timings": timings, "events": dict(self.events)}
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+
+stats = Stats() # shared by every module
+
+if os.environ.get("ITPAINT_STATS"):
+    atexit.register(stats.dump, os.environ["ITPAINT_STATS"])